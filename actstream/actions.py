@@ -1,12 +1,32 @@
 from datetime import datetime
+from threading import local
 
+from django.db.models import F, Q
+from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 
+from actstream import bloom, cache as actstream_cache
 from actstream.exceptions import check_actionable_model
+from actstream.gfk import sync_int_object_ids
+from actstream.signals import actions_bulk_created
 
+# Attribute memoizing the follow set of a user instance during template
+# rendering, see actstream.templatetags.activity_tags
+FOLLOWING_KEYS_ATTR = '_actstream_following_keys'
 
-def follow(user, obj, send_action=True, actor_only=True):
+# Set while _bulk_delete deletes rows whose counters are adjusted in bulk
+_bulk = local()
+
+
+def _forget_following_keys(user):
+    for attr in (FOLLOWING_KEYS_ATTR, bloom.FILTER_ATTR):
+        if hasattr(user, attr):
+            delattr(user, attr)
+
+
+def follow(user, obj, send_action=True, actor_only=True, verbs=None,
+        roles=None):
     """
     Creates a relationship allowing the object's activities to appear in the
     user's stream.
@@ -21,17 +41,31 @@ def follow(user, obj, send_action=True, actor_only=True):
     ``False`` to also include actions where this object is the action_object or
     the target.
 
+    ``verbs`` limits the stream to actions with one of the given verbs and
+    ``roles`` to actions where the object is one of ``'actor'``,
+    ``'target'`` or ``'action_object'``, overriding ``actor_only``. Following
+    an object again replaces its previous options.
+
     Example::
 
         follow(request.user, group, actor_only=False)
+        follow(request.user, project, verbs=['released'])
     """
-    from actstream.models import Follow, action
+    from actstream.models import Follow, ROLES, action, join_list
 
     check_actionable_model(obj)
+    options = {'actor_only': actor_only, 'verbs': join_list(verbs),
+        'roles': join_list(roles, ROLES)}
     follow, created = Follow.objects.get_or_create(user=user,
         object_id=obj.pk,
         content_type=ContentType.objects.get_for_model(obj),
-        actor_only=actor_only)
+        defaults=options)
+    if not created and any(getattr(follow, name) != value
+            for name, value in options.items()):
+        for name, value in options.items():
+            setattr(follow, name, value)
+        follow.save()
+    _forget_following_keys(user)
     if send_action and created:
         action.send(user, verb=_('started following'), target=obj)
     return follow
@@ -53,10 +87,219 @@ def unfollow(user, obj, send_action=False):
     check_actionable_model(obj)
     Follow.objects.filter(user=user, object_id=obj.pk,
         content_type=ContentType.objects.get_for_model(obj)).delete()
+    _forget_following_keys(user)
     if send_action:
         action.send(user, verb=_('stopped following'), target=obj)
 
 
+def _group_by_content_type(objects):
+    """
+    Returns a dictionary of ``{content_type: {object_id: object}}`` for the
+    given actionable objects.
+    """
+    grouped = {}
+    for obj in objects:
+        check_actionable_model(obj)
+        grouped.setdefault(ContentType.objects.get_for_model(obj), {})[
+            smart_unicode(obj.pk)] = obj
+    return grouped
+
+
+def _followed_q(grouped):
+    q = Q()
+    for content_type, objects in grouped.iteritems():
+        q = q | Q(content_type=content_type, object_id__in=objects.keys())
+    return q
+
+
+def _adjust_followers(grouped, delta):
+    from actstream.models import FollowCounter
+
+    for content_type, objects in grouped.iteritems():
+        FollowCounter.objects.filter(content_type=content_type,
+            object_id__in=objects.keys()).update(
+                followers=F('followers') + delta)
+
+
+def _drop_suggestions(user, grouped):
+    from actstream.models import FollowSuggestion
+
+    FollowSuggestion.objects.filter(_followed_q(grouped), user=user).delete()
+
+
+def _bulk_create(model, instances):
+    """
+    Inserts ``instances`` with a single query when the manager supports
+    ``bulk_create`` (Django 1.4+), one by one otherwise. Returns True if the
+    bulk insert was used, in which case no model signals were sent.
+    """
+    for instance in instances:
+        sync_int_object_ids(instance)
+    if hasattr(model.objects, 'bulk_create'):
+        model.objects.bulk_create(instances)
+        return True
+    for instance in instances:
+        instance.save()
+    return False
+
+
+def _bulk_delete(model, pks, chunk_size=500):
+    """
+    Deletes the rows of ``model`` with the given primary keys, one queryset
+    delete per ``chunk_size`` keys. ``follow_counters_handler`` is suspended
+    meanwhile: callers adjust the counters with one query per content type.
+    """
+    _bulk.deleting = True
+    try:
+        for start in range(0, len(pks), chunk_size):
+            model.objects.filter(pk__in=pks[start:start + chunk_size]).delete()
+    finally:
+        _bulk.deleting = False
+
+
+def _send_many(user, verb, objects):
+    """
+    Creates one ``<user> <verb> <object>`` action per object in bulk. The
+    ``actions_bulk_created`` signal gets the actions read back from the
+    database, since ``bulk_create`` does not set primary keys.
+    """
+    from actstream.models import Action
+
+    actor_content_type = ContentType.objects.get_for_model(user)
+    now = datetime.now()
+    actions = [Action(actor_content_type=actor_content_type,
+        actor_object_id=user.pk, verb=unicode(verb), timestamp=now,
+        target_content_type=ContentType.objects.get_for_model(obj),
+        target_object_id=obj.pk) for obj in objects]
+    if not actions:
+        return
+    last_pk = Action.objects.order_by('-pk').values_list('pk',
+        flat=True)[:1]
+    last_pk = last_pk and last_pk[0] or 0
+    if _bulk_create(Action, actions):
+        if actions[0].pk is None:
+            targets = Q()
+            for content_type, by_id in \
+                    _group_by_content_type(objects).iteritems():
+                targets = targets | Q(target_content_type=content_type,
+                    target_object_id__in=by_id.keys())
+            actions = list(Action.objects.filter(targets, pk__gt=last_pk,
+                actor_content_type=actor_content_type,
+                actor_object_id=user.pk, verb=unicode(verb)).order_by('pk'))
+        actions_bulk_created.send(sender=Action, actions=actions)
+
+
+def follow_many(user, objects, send_action=True, actor_only=True,
+        verbs=None, roles=None):
+    """
+    Follows every object in ``objects`` at once. Like with ``follow``, the
+    follows that already exist take the given options and send no action.
+
+    Returns the list of created ``Follow`` instances.
+
+    Takes the same options as ``follow`` but inserts the new follows and their
+    ``<user> started following <object>`` actions with one query each.
+
+    Example::
+
+        follow_many(request.user, Group.objects.filter(featured=True))
+    """
+    from actstream.models import Follow, FollowCounter, ROLES, join_list
+
+    grouped = _group_by_content_type(objects)
+    if not grouped:
+        return []
+    verbs, roles = join_list(verbs), join_list(roles, ROLES)
+    existing_follows = Follow.objects.filter(_followed_q(grouped), user=user)
+    existing = set(existing_follows.values_list('content_type_id',
+        'object_id'))
+    if existing and existing_follows.exclude(actor_only=actor_only,
+            verbs=verbs, roles=roles).update(actor_only=actor_only,
+            verbs=verbs, roles=roles):
+        actstream_cache.bump_follow_version(user.pk)
+    follows, followed = [], []
+    for content_type, objects in grouped.iteritems():
+        for object_id, obj in objects.iteritems():
+            if (content_type.pk, object_id) in existing:
+                continue
+            follows.append(Follow(user=user, content_type=content_type,
+                object_id=object_id, actor_only=actor_only, verbs=verbs,
+                roles=roles))
+            followed.append(obj)
+    if not follows:
+        return []
+
+    if _bulk_create(Follow, follows):
+        actstream_cache.bump_follow_version(user.pk)
+        _drop_suggestions(user, _group_by_content_type(followed))
+        _adjust_followers(_group_by_content_type(followed), 1)
+        FollowCounter.objects.adjust(
+            ContentType.objects.get_for_model(user).pk, user.pk,
+            'following', len(follows))
+    _forget_following_keys(user)
+    if send_action:
+        _send_many(user, _('started following'), followed)
+    return follows
+
+
+def unfollow_many(user, objects, send_action=False):
+    """
+    Removes the "follow" relationships between ``user`` and every object in
+    ``objects``, deleting them in chunks and adjusting the counters in bulk.
+
+    Returns the number of removed follows.
+
+    Example::
+
+        unfollow_many(request.user, group.user_set.all())
+    """
+    from actstream.models import Follow, FollowCounter
+
+    grouped = _group_by_content_type(objects)
+    if not grouped:
+        return 0
+    rows = list(Follow.objects.filter(_followed_q(grouped), user=user)
+        .values_list('pk', 'content_type_id', 'object_id'))
+    if not rows:
+        return 0
+
+    _bulk_delete(Follow, [row[0] for row in rows])
+    actstream_cache.bump_follow_version(user.pk)
+    removed = {}
+    for content_type, objects in grouped.iteritems():
+        for pk, content_type_id, object_id in rows:
+            if content_type_id == content_type.pk:
+                removed.setdefault(content_type, {})[object_id] = \
+                    objects[smart_unicode(object_id)]
+    _adjust_followers(removed, -1)
+    FollowCounter.objects.adjust(ContentType.objects.get_for_model(user).pk,
+        user.pk, 'following', -len(rows))
+    _forget_following_keys(user)
+    if send_action:
+        _send_many(user, _('stopped following'), sum([objects.values() for
+            objects in removed.values()], []))
+    return len(rows)
+
+
+def suggest_follows(user, n=10):
+    """
+    Returns up to ``n`` objects ``user`` may want to follow, best first.
+
+    Suggestions are precomputed by the ``actstream_build_suggestions``
+    management command; this only reads them.
+
+    Example::
+
+        suggest_follows(request.user, 5)
+    """
+    from actstream.models import FollowSuggestion
+
+    return [suggestion.suggested_object for suggestion in
+        FollowSuggestion.objects.filter(user=user)[:n]
+            .fetch_generic_relations()
+        if suggestion.suggested_object is not None]
+
+
 def is_following(user, obj):
     """
     Checks if a "follow" relationship exists.
@@ -70,8 +313,7 @@ def is_following(user, obj):
     from actstream.models import Follow
 
     check_actionable_model(obj)
-    return bool(Follow.objects.filter(user=user, object_id=obj.pk,
-        content_type=ContentType.objects.get_for_model(obj)).count())
+    return Follow.objects.is_following(user, obj)
 
 
 def action_handler(verb, **kwargs):
@@ -101,3 +343,79 @@ def action_handler(verb, **kwargs):
                     ContentType.objects.get_for_model(obj))
 
     newaction.save()
+
+
+def prune_actions(content_type_id, object_ids, tombstone=False):
+    """
+    Deletes every action referring to one of ``object_ids`` of the given
+    content type as its actor, target or action_object. If ``tombstone`` is
+    ``True`` the actions are hidden (``public=False``) instead.
+
+    Returns the number of affected actions.
+    """
+    from actstream.models import Action
+
+    actions = Action.objects.referencing(content_type_id, object_ids)
+    if tombstone:
+        return actions.update(public=False)
+    count = actions.count()
+    actions.delete()
+    return count
+
+
+def prune_deleted_object(sender, instance, **kwargs):
+    """
+    ``post_delete`` handler pruning the actions of a deleted actionable
+    object, enabled by the ``ACTSTREAM_PRUNE_ON_DELETE`` setting.
+    """
+    from actstream.settings import MODELS, PRUNE_ON_DELETE
+
+    if not sender in MODELS.values():
+        return
+    prune_actions(ContentType.objects.get_for_model(sender).pk,
+        [instance.pk], tombstone=PRUNE_ON_DELETE == 'tombstone')
+
+
+def follow_counters_handler(sender, instance, signal, created=False,
+        **kwargs):
+    """
+    Keeps ``FollowCounter`` in sync as ``Follow`` rows are created and
+    deleted.
+    """
+    from django.db.models.signals import post_save
+    from django.contrib.auth.models import User
+    from actstream.models import FollowCounter
+
+    if signal is post_save and not created or \
+            getattr(_bulk, 'deleting', False):
+        return
+    delta = created and 1 or -1
+    FollowCounter.objects.adjust(instance.content_type_id, instance.object_id,
+        'followers', delta)
+    FollowCounter.objects.adjust(ContentType.objects.get_for_model(User).pk,
+        instance.user_id, 'following', delta)
+
+
+def follow_counters_prune_handler(sender, instance, **kwargs):
+    """
+    Deletes the counters of a deleted actionable object.
+    """
+    from actstream.models import FollowCounter
+    from actstream.settings import MODELS
+
+    if sender in MODELS.values():
+        FollowCounter.objects.filter(
+            content_type=ContentType.objects.get_for_model(sender),
+            object_id=smart_unicode(instance.pk)).delete()
+
+
+def follow_suggestions_handler(sender, instance, created=False, **kwargs):
+    """
+    Drops the suggestion of an object as soon as the user follows it.
+    """
+    from actstream.models import FollowSuggestion
+
+    if created:
+        FollowSuggestion.objects.filter(user=instance.user_id,
+            content_type=instance.content_type_id,
+            object_id=instance.object_id).delete()
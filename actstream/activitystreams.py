@@ -0,0 +1,148 @@
+"""
+JSON Activity Streams 1.0 serialization of streams.
+
+Actions are read with ``values()`` instead of being instantiated, and the
+objects they refer to are loaded with one ``in_bulk`` query per content type
+and only for the selected fields.
+See http://activitystrea.ms/specs/json/1.0/
+"""
+from datetime import datetime
+
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.encoding import smart_unicode
+from django.utils.feedgenerator import rfc3339_date
+
+from actstream import registry
+from actstream.urlcache import memoize_urls, object_url, reverse
+
+FIELDS = ('id', 'published', 'verb', 'content', 'actor', 'object', 'target')
+
+# Activity Streams property -> Action generic foreign key
+OBJECT_FIELDS = {
+    'actor': 'actor',
+    'object': 'action_object',
+    'target': 'target',
+}
+
+OBJECT_TYPES = {
+    ('auth', 'user'): 'person',
+}
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def parse_fields(value):
+    """
+    Parses a comma separated list of fields, all fields if empty. Raises
+    ``ValueError`` for unknown fields.
+    """
+    if not value:
+        return FIELDS
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    for field in fields:
+        if not field in FIELDS:
+            raise ValueError('Unknown field %r' % field)
+    return fields
+
+
+def encode_cursor(timestamp, pk):
+    return '%s_%s' % (timestamp.strftime(CURSOR_FORMAT), pk)
+
+
+def decode_cursor(value):
+    """
+    Returns the ``(timestamp, pk)`` pair of a cursor. Raises ``ValueError``
+    for malformed cursors.
+    """
+    timestamp, pk = value.split('_')
+    return datetime.strptime(timestamp, CURSOR_FORMAT), int(pk)
+
+
+def _load_objects(rows, fields, using):
+    """
+    Returns the objects referenced by ``rows``, keyed by ``(content type
+    id, object id)``, with one query per content type.
+    """
+    object_ids = {}
+    for row in rows:
+        for field in fields:
+            content_type_id = row['%s_content_type' % field]
+            if content_type_id is not None:
+                object_ids.setdefault(content_type_id, set()).add(
+                    row['%s_object_id' % field])
+    content_types = registry.get_content_types(object_ids.keys(), using)
+    objects = {}
+    for content_type_id, ids in object_ids.items():
+        model_class = content_types[content_type_id].model_class()
+        if model_class is None:
+            continue
+        for obj in model_class._default_manager.using(using).filter(
+                pk__in=ids):
+            objects[(content_type_id, smart_unicode(obj.pk))] = obj
+    return objects
+
+
+def serialize_object(content_type, obj, absolute_uri):
+    """
+    Activity Streams object for ``obj``, an instance of ``content_type``.
+    """
+    url = absolute_uri(object_url(obj))
+    return {
+        'id': url,
+        'objectType': OBJECT_TYPES.get((content_type.app_label,
+            content_type.model), content_type.model),
+        'displayName': unicode(obj),
+        'url': url,
+    }
+
+
+@memoize_urls
+def serialize(queryset, fields=FIELDS, limit=20,
+        absolute_uri=lambda url: url):
+    """
+    Serializes up to ``limit`` actions of ``queryset`` (newest first) with
+    the given ``fields``. Returns the Activity Streams collection and the
+    cursor of the next page, None on the last page.
+
+    ``absolute_uri`` turns the paths of actions and objects into absolute
+    URIs, usually ``request.build_absolute_uri``.
+    """
+    using = queryset.db or DEFAULT_DB_ALIAS
+    object_fields = [OBJECT_FIELDS[field] for field in fields
+        if field in OBJECT_FIELDS]
+    columns = ['id', 'timestamp', 'verb', 'description']
+    for field in object_fields:
+        columns.extend(['%s_content_type' % field, '%s_object_id' % field])
+    rows = list(queryset.order_by('-timestamp', '-id').values(
+        *columns)[:limit + 1])
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+
+    objects = _load_objects(rows, object_fields, using)
+    content_types = registry.get_content_types(
+        set(key[0] for key in objects), using)
+    items = []
+    for row in rows:
+        item = {}
+        if 'id' in fields:
+            item['id'] = absolute_uri(reverse('actstream_detail',
+                (row['id'],)))
+        if 'published' in fields:
+            item['published'] = rfc3339_date(row['timestamp'])
+        if 'verb' in fields:
+            item['verb'] = row['verb']
+        if 'content' in fields and row['description']:
+            item['content'] = row['description']
+        for field in fields:
+            if not field in OBJECT_FIELDS:
+                continue
+            content_type_id = row['%s_content_type' % OBJECT_FIELDS[field]]
+            object_id = row['%s_object_id' % OBJECT_FIELDS[field]]
+            obj = objects.get((content_type_id, smart_unicode(object_id)))
+            if obj is not None:
+                item[field] = serialize_object(content_types[content_type_id],
+                    obj, absolute_uri)
+        items.append(item)
+    return {'items': items}, cursor
@@ -18,5 +18,18 @@ class FollowAdmin(admin.ModelAdmin):
     raw_id_fields = ('user', 'content_type')
 
 
+class WebhookSubscriptionAdmin(admin.ModelAdmin):
+    list_display = ('url', 'verbs', 'active')
+    list_filter = ('active',)
+
+
+class WebhookDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'attempts', 'next_attempt', 'last_error')
+    list_filter = ('subscription',)
+    raw_id_fields = ('action',)
+
+
 admin.site.register(models.Action, ActionAdmin)
 admin.site.register(models.Follow, FollowAdmin)
+admin.site.register(models.WebhookSubscription, WebhookSubscriptionAdmin)
+admin.site.register(models.WebhookDelivery, WebhookDeliveryAdmin)
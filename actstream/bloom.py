@@ -0,0 +1,113 @@
+"""
+Per-user Bloom filters over followed objects, used to answer "not following"
+without a query.
+
+A filter holds every ``(content_type_id, object_id)`` pair a user follows. A
+miss is a definite "not following"; a hit still goes to the database. Filters
+live in the Django cache under the follow version of the user (see
+``actstream.cache``), bumped whenever the user's follows change, and are
+rebuilt with a single query on the next check. A rebuild racing a change
+stores its filter under the version it started from, which readers no longer
+use.
+
+The filter of a user is loaded once and memoized on the user instance for the
+rest of the request.
+"""
+import math
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+
+FOLLOW_BLOOM = getattr(settings, 'ACTSTREAM_FOLLOW_BLOOM', False)
+FOLLOW_BLOOM_ERROR_RATE = getattr(settings,
+    'ACTSTREAM_FOLLOW_BLOOM_ERROR_RATE', 0.01)
+FOLLOW_BLOOM_TIMEOUT = getattr(settings, 'ACTSTREAM_FOLLOW_BLOOM_TIMEOUT',
+    60 * 60 * 24)
+
+# Attribute memoizing the filter of a user instance
+FILTER_ATTR = '_actstream_follow_bloom'
+
+
+class BloomFilter(object):
+    """
+    Fixed size Bloom filter of byte strings using double hashing over MD5.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+            math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) *
+            math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = md5(smart_str(key)).hexdigest()
+        first, second = int(digest[:16], 16), int(digest[16:], 16)
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self.bits[position // 8] & (1 << (position % 8)):
+                return False
+        return True
+
+
+def _key(content_type_id, object_id):
+    return '%s:%s' % (content_type_id, object_id)
+
+
+def version_key(user_id):
+    from actstream.cache import follow_version_key
+
+    return follow_version_key(user_id)
+
+
+def cache_key(user_id, version):
+    return 'actstream.follow_bloom.%s.%s' % (user_id, version)
+
+
+def build(user, version=None):
+    """
+    Builds and caches the filter of ``user`` from the ``Follow`` table.
+    """
+    from actstream.cache import get_versions
+    from actstream.models import Follow
+
+    if version is None:
+        version = get_versions([version_key(user.pk)])[0]
+    keys = Follow.objects.following_keys(user)
+    bloom = BloomFilter(len(keys), FOLLOW_BLOOM_ERROR_RATE)
+    for content_type_id, object_id in keys:
+        bloom.add(_key(content_type_id, object_id))
+    cache.set(cache_key(user.pk, version), bloom, FOLLOW_BLOOM_TIMEOUT)
+    return bloom
+
+
+def might_follow(user, content_type_id, object_id):
+    """
+    False if ``user`` definitely does not follow the object.
+    """
+    from actstream.cache import get_versions
+
+    bloom = getattr(user, FILTER_ATTR, None)
+    if bloom is None:
+        version = get_versions([version_key(user.pk)])[0]
+        bloom = cache.get(cache_key(user.pk, version))
+        if bloom is None:
+            bloom = build(user, version)
+        setattr(user, FILTER_ATTR, bloom)
+    return _key(content_type_id, object_id) in bloom
+
+
+def invalidate(user_id):
+    from actstream.cache import bump_follow_version
+
+    bump_follow_version(user_id)
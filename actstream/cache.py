@@ -0,0 +1,210 @@
+"""
+Version numbers for cached renderings of activity.
+
+Every object and every model referenced by an action has a version number in
+the Django cache, bumped whenever an action referencing it is saved or
+deleted. Cache keys of rendered content embed the versions they depend on, so
+a bump makes stale entries unreachable and they simply expire.
+
+Versions start from the current time in milliseconds, so a version that was
+evicted from the cache never comes back with a value used before.
+
+Rendered actions depend on the objects they refer to rather than on their
+activity, and use separate object versions bumped when an actionable object
+or the action itself is saved or deleted.
+
+Every user also has a follow version, bumped whenever the follows of the
+user change. Changes saved inside a managed transaction bump it again when
+the request finishes, after the commit, so content computed from the follows
+before the commit is not kept under the new version.
+"""
+from hashlib import md5
+from threading import local
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.encoding import smart_str
+from django.utils.translation import get_language
+
+FEED_CACHE = getattr(settings, 'ACTSTREAM_FEED_CACHE', False)
+FEED_CACHE_TIMEOUT = getattr(settings, 'ACTSTREAM_FEED_CACHE_TIMEOUT',
+    60 * 15)
+FEED_SNAPSHOTS = getattr(settings, 'ACTSTREAM_FEED_SNAPSHOTS', False)
+FEED_SNAPSHOT_TIMEOUT = getattr(settings, 'ACTSTREAM_FEED_SNAPSHOT_TIMEOUT',
+    60 * 5)
+ACTION_CACHE = getattr(settings, 'ACTSTREAM_ACTION_CACHE', False)
+ACTION_CACHE_TIMEOUT = getattr(settings, 'ACTSTREAM_ACTION_CACHE_TIMEOUT',
+    60 * 60 * 24)
+VERSION_TIMEOUT = 60 * 60 * 24
+
+_pending = local()
+
+
+def version_key(content_type_id, object_id=None):
+    """
+    Cache key of the version of an object, or of a whole model if
+    ``object_id`` is None.
+    """
+    if object_id is None:
+        return 'actstream:version:%s' % content_type_id
+    return 'actstream:version:%s:%s' % (content_type_id,
+        md5(smart_str(object_id)).hexdigest())
+
+
+def _new_version():
+    return int(time() * 1000)
+
+
+def get_versions(keys):
+    """
+    Returns the current versions of ``keys``, initializing missing ones.
+    """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if not key in versions:
+            version = _new_version()
+            if not cache.add(key, version, VERSION_TIMEOUT):
+                version = cache.get(key, version)
+            versions[key] = version
+    return [versions[key] for key in keys]
+
+
+def bump(keys):
+    """
+    Increments the versions of ``keys``.
+    """
+    for key in set(keys):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), VERSION_TIMEOUT)
+
+
+def action_version_keys(action):
+    """
+    Version keys of every object and model ``action`` refers to.
+    """
+    keys = []
+    for field in ('actor', 'target', 'action_object'):
+        content_type_id = getattr(action, '%s_content_type_id' % field)
+        if content_type_id is not None:
+            keys.append(version_key(content_type_id))
+            keys.append(version_key(content_type_id,
+                getattr(action, '%s_object_id' % field)))
+    return keys
+
+
+def action_versions_handler(sender, instance=None, actions=(), **kwargs):
+    """
+    Bumps the versions of the objects and models of saved, deleted and bulk
+    created actions.
+    """
+    keys = []
+    for action in (instance is not None and [instance] or actions):
+        keys.extend(action_version_keys(action))
+    bump(keys)
+
+
+def follow_version_key(user_id):
+    """
+    Cache key of the version of the follows of a user.
+    """
+    return 'actstream:follows:%s' % user_id
+
+
+def bump_follow_version(user_id):
+    """
+    Bumps the follow version of the user. Inside a managed transaction the
+    version is bumped again by ``flush_follow_versions`` once the
+    transaction is committed.
+    """
+    bump([follow_version_key(user_id)])
+    if transaction.is_managed():
+        if getattr(_pending, 'user_ids', None) is None:
+            _pending.user_ids = set()
+        _pending.user_ids.add(user_id)
+
+
+def flush_follow_versions(**kwargs):
+    """
+    Bumps again the follow versions bumped inside a managed transaction.
+    Connected to ``request_finished``, sent after ``TransactionMiddleware``
+    commits; call it after committing outside of requests.
+    """
+    user_ids = getattr(_pending, 'user_ids', None)
+    if user_ids:
+        _pending.user_ids = None
+        bump([follow_version_key(user_id) for user_id in user_ids])
+
+
+def follow_versions_handler(sender, instance, **kwargs):
+    """
+    Bumps the follow version of the user of saved and deleted follows.
+    """
+    bump_follow_version(instance.user_id)
+
+
+def object_version_key(content_type_id, object_id):
+    """
+    Cache key of the version of the content of an object.
+    """
+    return 'actstream:object:%s:%s' % (content_type_id,
+        md5(smart_str(object_id)).hexdigest())
+
+
+def object_versions_handler(sender, instance=None, **kwargs):
+    """
+    Bumps the object version of saved and deleted actions and actionable
+    objects.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from actstream import settings as actstream_settings
+    from actstream.models import Action
+
+    if sender is Action or sender in actstream_settings.MODELS.values():
+        bump([object_version_key(ContentType.objects.get_for_model(
+            sender).pk, instance.pk)])
+
+
+def action_object_version_keys(action):
+    """
+    Object version keys of ``action`` and of the objects it refers to.
+    """
+    from django.contrib.contenttypes.models import ContentType
+
+    keys = [object_version_key(ContentType.objects.get_for_model(action).pk,
+        action.pk)]
+    for field in ('actor', 'target', 'action_object'):
+        content_type_id = getattr(action, '%s_content_type_id' % field)
+        if content_type_id is not None:
+            keys.append(object_version_key(content_type_id,
+                getattr(action, '%s_object_id' % field)))
+    return keys
+
+
+def action_fragment_keys(actions, template_names, variants):
+    """
+    Cache keys of ``actions`` rendered with the matching ``template_names``
+    and ``variants``, depending on the object versions of the actions and of
+    the objects they refer to. The versions are read with a single cache
+    query.
+    """
+    version_keys = [action_object_version_keys(action) for action in actions]
+    all_keys = list(set([key for keys in version_keys for key in keys]))
+    versions = dict(zip(all_keys, get_versions(all_keys)))
+    language = get_language()
+    return ['actstream:action:%s' % md5(smart_str('%s:%s:%s:%s:%s' % (
+        action.pk, template_name, variant, language,
+        [versions[key] for key in keys]))).hexdigest()
+        for action, template_name, variant, keys in zip(actions,
+        template_names, variants, version_keys)]
+
+
+def action_fragment_key(action, template_name, variant=''):
+    """
+    Cache key of ``action`` rendered with ``template_name``, see
+    ``action_fragment_keys``.
+    """
+    return action_fragment_keys([action], [template_name], [variant])[0]
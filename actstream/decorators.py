@@ -1,5 +1,16 @@
 from functools import wraps
 
+from django.db.models import Q
+
+
+def before(queryset, timestamp, pk):
+    """
+    Actions of ``queryset`` older than the action with ``timestamp`` and
+    ``pk``, newest first. Used for keyset pagination over streams.
+    """
+    return queryset.filter(Q(timestamp__lt=timestamp) |
+        Q(timestamp=timestamp, pk__lt=pk)).order_by('-timestamp', '-pk')
+
 
 def stream(func):
     """
@@ -15,13 +26,25 @@ def stream(func):
             def foobar(self, ...):
                 ...
 
+    Streams accept ``_offset`` and ``_limit`` to slice the queryset before the
+    generic relations are fetched, ``_before=(timestamp, pk)`` to only get
+    the actions following that one in ``('-timestamp', '-pk')`` order, and
+    ``_fetch=False`` to get the unevaluated queryset back without fetching
+    the generic relations at all.
     """
     @wraps(func)
     def wrapped(manager, *args, **kwargs):
         offset, limit = kwargs.pop('_offset', None), kwargs.pop('_limit', None)
+        cursor, fetch = kwargs.pop('_before', None), kwargs.pop('_fetch', True)
+        queryset = func(manager, *args, **kwargs)
+        if cursor is not None:
+            queryset = before(queryset, *cursor)
+        if not fetch:
+            if offset is None and limit is None:
+                return queryset
+            return queryset[offset:limit]
         try:
-            return func(manager, *args, **kwargs)[offset:limit]\
-                .fetch_generic_relations()
+            return queryset[offset:limit].fetch_generic_relations()
         except AttributeError:
-            return func(manager, *args, **kwargs).fetch_generic_relations()
+            return queryset.fetch_generic_relations()
     return wrapped
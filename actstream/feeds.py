@@ -1,6 +1,17 @@
+from copy import copy
+from email.utils import parsedate_tz, mktime_tz
+from hashlib import md5
+from time import mktime
+
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.shortcuts import get_object_or_404
-from django.core.urlresolvers import reverse
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.utils.encoding import smart_str
+from django.utils.http import http_date, parse_etags, quote_etag
+from django.core.cache import cache
 from django.utils.feedgenerator import Atom1Feed, rfc3339_date, get_tag_uri
+from django.utils.xmlutils import SimplerXMLGenerator
 from django.contrib.contenttypes.models import ContentType
 
 try:
@@ -8,7 +19,38 @@ try:
 except ImportError:   # Pre 1.2
     from django.contrib.syndication.feeds import Feed
 
-from actstream.models import model_stream, user_stream, action_object_stream
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:   # Pre 1.5, iterators are sent as they are consumed
+    StreamingHttpResponse = HttpResponse
+
+from actstream import cache as actstream_cache, \
+    settings as actstream_settings
+from actstream.decorators import before
+from actstream.models import model_stream, user_stream, \
+    action_object_stream, action_objects_stream
+from actstream.registry import get_content_type, get_content_type_or_404
+from actstream.urlcache import memoize_urls, object_url
+
+
+class _Buffer(object):
+    """
+    File-like object collecting the output of an XML generator until it is
+    drained.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self.chunks = ''.join(self.chunks), []
+        return data
 
 
 class AtomWithContentFeed(Atom1Feed):
@@ -19,34 +61,314 @@ class AtomWithContentFeed(Atom1Feed):
             handler.addQuickElement(u"content", item['content'],
                 {'type': 'html'})
 
+    def iter_write(self, encoding, item_chunks=None):
+        """
+        Generator writing the feed piece by piece: the root elements first,
+        then the entries of every list of items from ``item_chunks`` (the
+        items of the feed by default) as soon as the list is available.
+        """
+        out = _Buffer()
+        handler = SimplerXMLGenerator(out, encoding)
+        handler.startDocument()
+        handler.startElement(u"feed", self.root_attributes())
+        self.add_root_elements(handler)
+        yield out.drain()
+        for items in item_chunks or [self.items]:
+            for item in items:
+                handler.startElement(u"entry", self.item_attributes(item))
+                self.add_item_elements(handler, item)
+                handler.endElement(u"entry")
+            yield out.drain()
+        handler.endElement(u"feed")
+        yield out.drain()
+
+
+def _timestamp(value):
+    return int(mktime(value.timetuple()))
+
+
+def not_modified(request, etag, last_modified):
+    """
+    True if the conditional headers of ``request`` match the current ``etag``
+    or ``last_modified`` datetime of a resource.
+    """
+    if not request.method in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        parsed = parsedate_tz(if_modified_since)
+        return parsed is not None and \
+            mktime_tz(parsed) >= _timestamp(last_modified)
+    return False
+
+
+def snapshot_key(request):
+    """
+    Cache key of the snapshot of the feed at the path of ``request``. Feeds
+    contain absolute URLs, so the host and scheme are part of the key.
+    """
+    return 'actstream:snapshot:%s' % md5(smart_str('%s://%s%s' % (
+        request.is_secure() and 'https' or 'http', request.get_host(),
+        request.path_info))).hexdigest()
+
 
-class ObjectActivityFeed(Feed):
+def get_snapshot(request):
+    """
+    Returns the ``(mime_type, content, etag, last_modified)`` snapshot of the
+    feed at the path of ``request``, built by ``actstream_build_feeds``, or
+    None. Snapshots built before one of the versions they depend on was
+    bumped are not served.
+    """
+    if actstream_cache.FEED_SNAPSHOTS and request.method in ('GET', 'HEAD') \
+            and not request.GET:
+        stored = cache.get(snapshot_key(request))
+        if stored:
+            snapshot, keys, versions = stored
+            if actstream_cache.get_versions(keys) == versions:
+                return snapshot
+
+
+def store_snapshot(request, snapshot, keys, versions, timeout=None):
+    """
+    Stores the snapshot of the feed rendered for ``request``, valid as long
+    as the version keys ``keys`` keep the ``versions`` read before rendering
+    it.
+    """
+    cache.set(snapshot_key(request), (snapshot, keys, versions),
+        timeout or actstream_cache.FEED_SNAPSHOT_TIMEOUT)
+
+
+class ActivityFeed(Feed):
+    """
+    Base class of the activity feeds. Subclasses return their actions from
+    ``stream``.
+
+    Responses carry ``ETag`` and ``Last-Modified`` headers computed from the
+    newest action of the stream, and conditional requests for an
+    unchanged feed get a ``304 Not Modified`` without loading any action.
+
+    With ``ACTSTREAM_FEED_CACHE`` enabled, feeds returning version keys from
+    ``cache_versions`` keep their rendered body and validators in the cache
+    until a new action bumps one of those versions.
+
+    Each response holds ``item_limit`` actions, the page being selected with
+    the ``page`` query string parameter.
+
+    Feeds with ``streaming`` enabled and a feed type providing ``iter_write``
+    load and send their actions ``chunk_size`` at a time instead of
+    rendering the whole document in memory. Streaming feeds are not cached.
+    """
+    item_limit = actstream_settings.FEED_ITEMS
+    page = 1
+    streaming = False
+    chunk_size = 100
+    chunk = None
+
+    def stream(self, obj, **kwargs):
+        """
+        Returns the stream of actions of the feed for ``obj``. Keyword
+        arguments are passed on to the stream method of the manager.
+        """
+        raise NotImplementedError
+
+    def items(self, obj):
+        if self.chunk is not None:
+            return self.chunk
+        offset = (self.page - 1) * self.item_limit
+        return self.stream(obj, _offset=offset,
+            _limit=offset + self.item_limit)
+
+    def for_request(self, request):
+        """
+        Returns a copy of the feed for the page requested by ``request``.
+        Feeds are shared between requests and must not be modified.
+        """
+        try:
+            page = int(request.GET.get('page', 1))
+        except ValueError:
+            raise Http404('Invalid page.')
+        if page < 1:
+            raise Http404('Invalid page.')
+        feed = copy(self)
+        feed.page = page
+        return feed
+
+    @memoize_urls
+    def get_feed(self, obj, request):
+        return super(ActivityFeed, self).get_feed(obj, request)
+
+    def iter_chunks(self, obj):
+        """
+        Yields the actions of the current page in lists of at most
+        ``chunk_size``. The first list is found by offset, the following ones
+        by ``(timestamp, id)`` from the last action of the previous list, so
+        every list costs one indexed query and one generic relation fetch.
+        """
+        remaining = self.item_limit
+        queryset = self.stream(obj, _fetch=False).order_by('-timestamp', '-id')
+        chunk = queryset[(self.page - 1) * self.item_limit:]
+        while remaining > 0:
+            actions = list(chunk[:min(self.chunk_size, remaining)]
+                .fetch_generic_relations())
+            if not actions:
+                break
+            yield actions
+            remaining -= len(actions)
+            chunk = before(queryset, actions[-1].timestamp, actions[-1].pk)
+
+    def iter_feed(self, obj, request):
+        """
+        Returns an iterator over the pieces of the streamed feed document.
+        """
+        def get_feed(chunk):
+            feed = copy(self)
+            feed.chunk = chunk
+            return feed.get_feed(obj, request)
+
+        return get_feed([]).iter_write('utf-8', (get_feed(chunk).items
+            for chunk in self.iter_chunks(obj)))
+
+    def is_streaming(self):
+        return self.streaming and hasattr(self.feed_type, 'iter_write')
+
+    def object_key(self, obj):
+        """
+        String identifying ``obj``, a model instance or a model class.
+        """
+        content_type = ContentType.objects.get_for_model(obj)
+        if isinstance(obj, type):
+            return str(content_type.pk)
+        return '%s:%s' % (content_type.pk, smart_str(obj.pk))
+
+    def cache_versions(self, obj):
+        """
+        Version keys (see ``actstream.cache``) the feed for ``obj`` depends
+        on, None if it can not be cached.
+        """
+        return None
+
+    def cache_key(self, request, obj):
+        """
+        Cache key of the rendered feed for ``obj``, None if it is not cached.
+        """
+        if not actstream_cache.FEED_CACHE or obj is None or \
+                self.is_streaming():
+            return None
+        keys = self.cache_versions(obj)
+        if keys is None:
+            return None
+        return 'actstream:feed:%s' % md5('%s.%s:%s:%s:%s:%s:%s' % (
+            self.__module__, self.__class__.__name__, self.object_key(obj),
+            self.page, smart_str(request.get_host()), request.is_secure(),
+            actstream_cache.get_versions(keys))).hexdigest()
+
+    def validator_versions(self, obj):
+        """
+        Version keys embedded in the ETag of the feed for ``obj``, for the
+        changes the newest action does not reveal. The ``cache_versions``,
+        kept up to date with ``ACTSTREAM_FEED_CACHE`` enabled, so deleted
+        and hidden actions change the ETag too.
+        """
+        if actstream_cache.FEED_CACHE:
+            return self.cache_versions(obj)
+
+    def validators(self, obj):
+        """
+        Returns the ``(etag, last_modified)`` pair of the feed for ``obj``.
+
+        Both come from the newest action of the stream, loaded with a single
+        indexed query. The ETag also embeds the versions of
+        ``validator_versions``.
+        """
+        if obj is None:
+            return None, None
+        newest = list(self.stream(obj, _fetch=False).order_by('-timestamp',
+            '-id').values_list('id', 'timestamp')[:1]) or [(None, None)]
+        newest_id, last_modified = newest[0]
+        versions = None
+        keys = self.validator_versions(obj)
+        if keys:
+            versions = actstream_cache.get_versions(keys)
+        etag = md5('%s:%s:%s:%s:%s:%s' % (self.__class__.__name__,
+            self.object_key(obj), self.page, newest_id, last_modified,
+            versions)).hexdigest()
+        return etag, last_modified
+
+    def __call__(self, request, *args, **kwargs):
+        return self.for_request(request).respond(request, *args, **kwargs)
+
+    def render(self, request, obj):
+        """
+        Returns the mime type and the rendered document of the feed for
+        ``obj``.
+        """
+        feedgen = self.get_feed(obj, request)
+        return feedgen.mime_type, feedgen.writeString('utf-8')
+
+    def respond(self, request, *args, **kwargs):
+        obj = key = None
+        cached = get_snapshot(request)
+        if not cached:
+            try:
+                obj = self.get_object(request, *args, **kwargs)
+            except ObjectDoesNotExist:
+                raise Http404('Feed object does not exist.')
+            key = self.cache_key(request, obj)
+            cached = key and cache.get(key)
+        if cached:
+            mime_type, content, etag, last_modified = cached
+        else:
+            content = None
+            etag, last_modified = self.validators(obj)
+        if etag and not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        elif content is None and self.is_streaming():
+            response = StreamingHttpResponse(self.iter_feed(obj, request),
+                mimetype=self.feed_type.mime_type)
+        else:
+            if content is None:
+                mime_type, content = self.render(request, obj)
+                if key:
+                    cache.set(key, (mime_type, content, etag, last_modified),
+                        actstream_cache.FEED_CACHE_TIMEOUT)
+            response = HttpResponse(content, mimetype=mime_type)
+        if etag:
+            response['ETag'] = quote_etag(etag)
+        if last_modified:
+            response['Last-Modified'] = http_date(_timestamp(last_modified))
+        return response
+
+
+class ObjectActivityFeed(ActivityFeed):
     """
     Feed of Activity for a given object (where the object is the Object or
     Target).
     """
 
     def get_object(self, request, content_type_id, object_id):
-        return get_object_or_404(ContentType, pk=content_type_id)\
-            .get_object_for_this_type(pk=object_id)
+        return get_object_or_404(
+            get_content_type_or_404(content_type_id).model_class(),
+            pk=object_id)
 
     def title(self, obj):
         return 'Activity for %s' % obj
 
     def link(self, obj):
-        if hasattr(obj, 'get_absolute_url'):
-            return obj.get_absolute_url()
-        return reverse('actstream_actor', None,
-                    (ContentType.objects.get_for_model(obj).pk, obj.pk))
+        return object_url(obj)
 
     def description(self, obj):
         return 'Activity for %s' % obj
 
-    def items(self, obj):
-        i = action_object_stream(obj)
-        if i:
-            return i[:30]
-        return []
+    def stream(self, obj, **kwargs):
+        return action_object_stream(obj, **kwargs)
+
+    def cache_versions(self, obj):
+        return [actstream_cache.version_key(
+            ContentType.objects.get_for_model(obj).pk, obj.pk)]
 
     def item_extra_kwargs(self, obj):
         return  {
@@ -78,13 +400,12 @@ class ActivityStreamsFeed(AtomWithContentFeed):
 
         if 'actor' in item:
             handler.startElement('author', {})
-            handler.addQuickElement('name', item['actor'].display_name)
-            handler.addQuickElement('uri', get_tag_uri(
-                item['actor'].get_absolute_url(), None))
-            handler.addQuickElement('id', item['actor'].get_absolute_url())
+            handler.addQuickElement('name', item['actor_name'])
+            handler.addQuickElement('uri', get_tag_uri(item['actor_url'], None))
+            handler.addQuickElement('id', item['actor_url'])
             handler.addQuickElement('activity: object-type', 'person')
-            handler.addQuickElement('link', get_tag_uri(
-                item['actor'].get_absolute_url(), None), {'type': 'text/html'})
+            handler.addQuickElement('link', get_tag_uri(item['actor_url'],
+                None), {'type': 'text/html'})
             handler.endElement('author')
 
         if 'object' in item:
@@ -93,7 +414,7 @@ class ActivityStreamsFeed(AtomWithContentFeed):
             handler.addQuickElement('title', item['object_title'])
             handler.addQuickElement('published',
                 rfc3339_date(item['object_timestamp']).decode('utf-8'))
-            handler.addQuickElement('link', item['object'].get_absolute_url(),
+            handler.addQuickElement('link', item['object_url'],
                 {'type': 'text/html'})
             handler.addQuickElement('activity: object-type',
                 item['object_object_type'])
@@ -110,6 +431,7 @@ class ActivityStreamsFeed(AtomWithContentFeed):
 
 class ActivityStreamsObjectActivityFeed(AtomObjectActivityFeed):
     feed_type = ActivityStreamsFeed
+    verb_uri_prefix = ''
 
     def feed_extra_kwargs(self, obj):
         """
@@ -125,47 +447,111 @@ class ActivityStreamsObjectActivityFeed(AtomObjectActivityFeed):
         Add the 'content' field of the 'Entry' item, to be used by the custom
         feed generator.
         """
-        try:
-            object_id = obj.action_object.get_absolute_url()
-        except:
-            object_id = '%s/%s' % (obj.action_object_content_type.model,
-                obj.action_object.id)
-
-        object_id = get_tag_uri(object_id, None)
-
         item = {
             'content': obj.description,
-            'actor': obj.actor,
-            'verb': obj.verb_uri_prefix + obj.verb,
-            # action object
-            'object_timestamp': obj.timestamp,
-            'object': obj.action_object,
-            'object_id': object_id,
-            'object_title': unicode(obj.action_object),
-            'object_object_type': obj.action_object_content_type.model,
+            'verb': self.verb_uri_prefix + obj.verb,
         }
 
-        if obj.target:
-            try:
-                target_id = obj.target.get_absolute_url()
-            except Exception:
-                target_id = '%s/%s' % (obj.target_content_type.model,
-                    obj.action_object.id)
-
-            target_id = get_tag_uri(target_id, obj.timestamp)
+        if obj.actor:
+            item['actor'] = obj.actor
+            item['actor_name'] = unicode(obj.actor)
+            item['actor_url'] = self.object_url(obj.actor,
+                obj.actor_content_type_id)
+
+        if obj.action_object:
+            object_url = self.object_url(obj.action_object,
+                obj.action_object_content_type_id)
+            item['object_timestamp'] = obj.timestamp
+            item['object'] = obj.action_object
+            item['object_id'] = get_tag_uri(object_url, None)
+            item['object_url'] = object_url
+            item['object_title'] = unicode(obj.action_object)
+            item['object_object_type'] = get_content_type(
+                obj.action_object_content_type_id).model
 
+        if obj.target:
             item['target'] = obj.target
-            item['target_id'] = target_id
+            item['target_id'] = get_tag_uri(self.object_url(obj.target,
+                obj.target_content_type_id), obj.timestamp)
             item['target_title'] = unicode(obj.target)
-            item['target_object_type'] = obj.target_content_type.name
+            item['target_object_type'] = get_content_type(
+                obj.target_content_type_id).name
 
         return item
 
+    def object_url(self, obj, content_type_id):
+        """
+        URL of ``obj``, or a ``<model>/<pk>`` path for objects without
+        ``get_absolute_url`` whose primary key the ``actstream_actor`` view
+        can not take.
+        """
+        try:
+            return object_url(obj)
+        except NoReverseMatch:
+            return '%s/%s' % (get_content_type(content_type_id).model, obj.pk)
+
 
-class ModelActivityFeed(Feed):
+class MultiObjectActivityFeed(ActivityFeed):
+    """
+    Merged feed of Activity for several objects, given as a comma separated
+    list of ``content_type_id:object_id`` pairs in the ``objects`` query
+    string parameter. The actions of all objects are read with one query and
+    one generic relation fetch.
+    """
+
+    def get_object(self, request):
+        pairs = set()
+        for pair in request.GET.get('objects', '').split(','):
+            try:
+                content_type_id, object_id = pair.split(':', 1)
+            except ValueError:
+                raise Http404('Invalid object %r.' % pair)
+            content_type = get_content_type_or_404(content_type_id)
+            if not object_id or content_type.model_class() is None:
+                raise Http404('Invalid object %r.' % pair)
+            pairs.add((content_type.pk, object_id))
+        if len(pairs) > actstream_settings.FEED_MAX_OBJECTS:
+            raise Http404('Too many objects.')
+        return tuple(sorted(pairs))
+
+    def objects_param(self, objects):
+        return ','.join(['%s:%s' % pair for pair in objects])
+
+    def title(self, objects):
+        return 'Activity for %d objects' % len(objects)
+
+    def link(self, objects):
+        return '%s?objects=%s' % (reverse('actstream_objects_feed'),
+            self.objects_param(objects))
+
+    def description(self, objects):
+        return 'Activity for %s' % self.objects_param(objects)
+
+    def stream(self, objects, **kwargs):
+        return action_objects_stream(objects, **kwargs)
+
+    def object_key(self, objects):
+        return md5(smart_str(self.objects_param(objects))).hexdigest()
+
+    def cache_versions(self, objects):
+        return [actstream_cache.version_key(content_type_id, object_id)
+            for content_type_id, object_id in objects]
+
+    def item_extra_kwargs(self, obj):
+        return  {
+            'content': obj.description,
+        }
+
+
+class AtomMultiObjectActivityFeed(MultiObjectActivityFeed):
+    feed_type = AtomWithContentFeed
+    subtitle = MultiObjectActivityFeed.description
+
+
+class ModelActivityFeed(ActivityFeed):
 
     def get_object(self, request, content_type_id):
-        return get_object_or_404(ContentType, pk=content_type_id).model_class()
+        return get_content_type_or_404(content_type_id).model_class()
 
     def title(self, model):
         return 'Activity feed from %s' % model
@@ -177,19 +563,20 @@ class ModelActivityFeed(Feed):
     def description(self, model):
         return 'Public activities of %s' % model
 
-    def items(self, model):
-        i = model_stream(model)
-        if i:
-            return i[:30]
-        return []
+    def stream(self, model, **kwargs):
+        return model_stream(model, **kwargs)
+
+    def cache_versions(self, model):
+        return [actstream_cache.version_key(
+            ContentType.objects.get_for_model(model).pk)]
 
 
 class AtomModelActivityFeed(ModelActivityFeed):
-    feed_type = Atom1Feed
+    feed_type = AtomWithContentFeed
     subtitle = ModelActivityFeed.description
 
 
-class UserActivityFeed(Feed):
+class UserActivityFeed(ActivityFeed):
 
     def get_object(self, request):
         if request.user.is_authenticated():
@@ -201,21 +588,20 @@ class UserActivityFeed(Feed):
     def link(self, user):
         if not user:
             return reverse('actstream')
-        if hasattr(user, 'get_absolute_url'):
-            return user.get_absolute_url()
-        return reverse('actstream_actor', None,
-            (ContentType.objects.get_for_model(user).pk, user.pk))
+        return object_url(user)
 
     def description(self, user):
         return 'Public activities of actors you follow'
 
-    def items(self, user):
-        i = user_stream(user)
-        if i:
-            return i[:30]
-        return []
+    def stream(self, user, **kwargs):
+        return user_stream(user, **kwargs)
+
+    def validator_versions(self, user):
+        # Following or unfollowing changes the stream without a new action
+        return (super(UserActivityFeed, self).validator_versions(user) or
+            []) + [actstream_cache.follow_version_key(user.pk)]
 
 
 class AtomUserActivityFeed(UserActivityFeed):
-    feed_type = Atom1Feed
+    feed_type = AtomWithContentFeed
     subtitle = UserActivityFeed.description
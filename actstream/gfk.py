@@ -1,14 +1,105 @@
+import logging
+from time import time
+
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
 from django.db.models import Manager
 from django.db.models.query import QuerySet, EmptyQuerySet
 from django.utils.encoding import smart_unicode
 
-from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
 
+from actstream import registry
+from actstream.signals import generic_relations_fetched
+
 USE_PREFETCH = getattr(settings, 'USE_PREFETCH', False)
 FETCH_RELATIONS = getattr(settings, 'FETCH_RELATIONS', True)
 GFK_FETCH_DEPTH = getattr(settings, 'GFK_FETCH_DEPTH', 0)
+INT_OBJECT_IDS = getattr(settings, 'ACTSTREAM_INT_OBJECT_IDS', False)
+GFK_LOG_STATS = getattr(settings, 'ACTSTREAM_GFK_LOG_STATS', False)
+
+logger = logging.getLogger('actstream.gfk')
+
+INTEGER_FIELD_TYPES = ('AutoField', 'IntegerField', 'BigIntegerField',
+    'PositiveIntegerField', 'SmallIntegerField', 'PositiveSmallIntegerField')
+
+
+def has_integer_pk(model):
+    """
+    Returns True if the primary key of ``model`` is stored as an integer.
+    Primary keys that are relations (multi-table inheritance) are followed to
+    the field they point at.
+    """
+    if model is None:
+        return False
+    field = model._meta.pk
+    while getattr(field, 'rel', None):
+        field = field.rel.get_related_field()
+    return field.get_internal_type() in INTEGER_FIELD_TYPES
+
+
+def int_object_id(value):
+    """
+    Returns ``value`` as an integer if it survives the round trip through
+    ``int``, None otherwise.
+    """
+    try:
+        result = int(value)
+    except (TypeError, ValueError):
+        return None
+    if smart_unicode(result) != smart_unicode(value):
+        return None
+    return result
+
+
+def int_field_name(fk_field):
+    """
+    Name of the typed integer column shadowing the ``fk_field`` column.
+    """
+    return '%s_int' % fk_field
+
+
+def has_int_field(model, fk_field):
+    return int_field_name(fk_field) in [f.name for f in model._meta.fields]
+
+
+def object_id_lookup(model, fk_field, object_model, object_ids):
+    """
+    Returns the filter keyword arguments selecting ``object_ids`` of
+    ``object_model`` through the ``fk_field`` generic foreign key of ``model``.
+
+    When ``ACTSTREAM_INT_OBJECT_IDS`` is enabled and ``object_model`` has an
+    integer primary key the typed integer column is used instead of the
+    character column.
+    """
+    if INT_OBJECT_IDS and has_integer_pk(object_model) and \
+            has_int_field(model, fk_field):
+        int_ids = filter(lambda pk: pk is not None,
+            map(int_object_id, object_ids))
+        return {'%s__in' % int_field_name(fk_field): int_ids}
+    return {'%s__in' % fk_field: map(smart_unicode, object_ids)}
+
+
+def sync_int_object_ids(instance):
+    """
+    Copies the character object ids of every generic foreign key on
+    ``instance`` into their typed integer columns, for objects whose model has
+    an integer primary key. Other objects get None.
+    """
+    for gfk in instance._meta.virtual_fields:
+        if not isinstance(gfk, GenericForeignKey):
+            continue
+        int_field = int_field_name(gfk.fk_field)
+        if not hasattr(instance, int_field):
+            continue
+        ct_id = getattr(instance,
+            instance._meta.get_field(gfk.ct_field).column)
+        value = None
+        if ct_id is not None and has_integer_pk(registry.get_model_class(
+                ct_id, instance._state.db or DEFAULT_DB_ALIAS)):
+            value = int_object_id(getattr(instance, gfk.fk_field))
+        setattr(instance, int_field, value)
+
 
 class GFKManager(Manager):
     """
@@ -33,8 +124,16 @@ class GFKQuerySet(QuerySet):
 
     Extended in django-activity-stream to allow for multi db, text primary keys
     and empty querysets.
+
+    Every fetch sends the ``generic_relations_fetched`` signal with a ``stats``
+    dictionary holding the number of ``rows`` scanned, distinct
+    ``content_types``, query ``batches`` (the queryset itself plus one per
+    content type), ``queries`` run (the batches plus the ContentType lookups
+    missing from the registry), ``missing`` objects and the ``time`` spent in
+    seconds.
     """
     def fetch_generic_relations(self, *args):
+        start = time()
         qs = self._clone()
 
         if not FETCH_RELATIONS:
@@ -48,47 +147,77 @@ class GFKQuerySet(QuerySet):
         if USE_PREFETCH and hasattr(self, 'prefetch_related'):
             return qs.prefetch_related(*[g.name for g in gfk_fields])
 
-        ct_map, data_map = {}, {}
+        ct_map, data_map, pending = {}, {}, []
+        rows = batches = missing = 0
 
         for item in qs:
+            rows += 1
             for gfk in gfk_fields:
                 ct_id_field = self.model._meta.get_field(gfk.ct_field).column
-                if getattr(item, ct_id_field) is None: continue
-                if getattr(item, gfk.fk_field) is None: continue
-                ct_map.setdefault(getattr(item, ct_id_field), {}
-                    )[smart_unicode(getattr(item, gfk.fk_field))] = (gfk.name,
-                        item.pk)
-
-        ctypes = ContentType.objects.using(self.db).in_bulk(ct_map.keys())
-
-        for ct_id, items_ in ct_map.items():
-            if ct_id:
-                ct = ctypes[ct_id]
-                model_class = ct.model_class()
-                objects = model_class._default_manager.select_related(
-                    depth=GFK_FETCH_DEPTH)
-                for o in objects.filter(pk__in=items_.keys()):
-                    (gfk_name, item_id) = items_[smart_unicode(o.pk)]
-                    data_map[(ct_id, smart_unicode(o.pk))] = o
-
-        for item in qs:
-            for gfk in gfk_fields:
-                if getattr(item, gfk.fk_field) != None:
-                    ct_id_field = self.model._meta.get_field(gfk.ct_field)\
-                        .column
-                    ctype = getattr(item, ct_id_field)
-                    gfk_pk = smart_unicode(getattr(item, gfk.fk_field))
-                    key = smart_unicode(getattr(item, gfk.fk_field))
-                    if key in data_map:
-                        setattr(item, gfk.name, data_map[key])
-                    # If the value isn't found, we leave it as is
-
+                ct_id = getattr(item, ct_id_field)
+                object_id = self._object_id(item, gfk)
+                if ct_id is None or object_id is None:
+                    continue
+                ct_map.setdefault(ct_id, set()).add(object_id)
+                pending.append((item, gfk.name, (ct_id, object_id)))
+
+        ctypes, lookups = registry.load_content_types(ct_map.keys(),
+            using=self.db)
+
+        for ct_id, object_ids in ct_map.items():
+            model_class = ctypes[ct_id].model_class()
+            if model_class is None:
+                continue
+            objects = model_class._default_manager.select_related(
+                depth=GFK_FETCH_DEPTH)
+            batches += 1
+            for o in objects.filter(pk__in=object_ids):
+                data_map[(ct_id, o.pk)] = o
+                data_map[(ct_id, smart_unicode(o.pk))] = o
+
+        for item, gfk_name, key in pending:
+            if key in data_map:
+                setattr(item, gfk_name, data_map[key])
+            else:
+                # If the value isn't found, we leave it as is
+                missing += 1
+
+        self._send_stats({
+            'rows': rows,
+            'content_types': len(ct_map),
+            'batches': batches + 1,
+            'queries': batches + 1 + lookups,
+            'missing': missing,
+            'time': time() - start,
+        })
         return qs
 
+    def _send_stats(self, stats):
+        generic_relations_fetched.send(sender=self.model, stats=stats)
+        if GFK_LOG_STATS:
+            logger.info('fetch_generic_relations on %s: %d rows, '
+                '%d content types, %d batches, %d queries, %d missing, '
+                '%.4fs', self.model.__name__, stats['rows'],
+                stats['content_types'], stats['batches'], stats['queries'],
+                stats['missing'], stats['time'])
+
+    def _object_id(self, item, gfk):
+        """
+        The key ``item`` uses to refer to its ``gfk`` object: the typed
+        integer id if available, the character id otherwise.
+        """
+        if INT_OBJECT_IDS:
+            object_id = getattr(item, int_field_name(gfk.fk_field), None)
+            if object_id is not None:
+                return object_id
+        object_id = getattr(item, gfk.fk_field)
+        if object_id is not None:
+            return smart_unicode(object_id)
+
     def none(self):
         return self._clone(klass=EmptyGFKQuerySet)
 
 
 class EmptyGFKQuerySet(GFKQuerySet, EmptyQuerySet):
-    def fetch_generic_relations(self):
+    def fetch_generic_relations(self, *args):
         return self
@@ -0,0 +1,318 @@
+"""
+Compact, read only snapshot of the ``Follow`` table for graph queries.
+
+The snapshot is written by the ``actstream_build_follow_graph`` management
+command and stores, for every content type, two adjacency lists as sorted
+arrays of 64 bit integers: the followers of each object and the objects each
+user follows. Files are memory mapped, so every process serving requests shares
+the same pages, and lookups are binary searches over the mapped arrays.
+
+File layout (all integers little endian)::
+
+    header   magic, version, user content type id, section count
+    sections content type id, kind, key count, value count, data offset
+    data     keys[key count], offsets[key count + 1], values[value count]
+
+Only objects with integer primary keys are included.
+"""
+import mmap
+import os
+import struct
+from time import time
+
+from django.conf import settings
+
+MAGIC = b'ASFG'
+VERSION = 1
+FOLLOWERS, FOLLOWING = 0, 1
+
+HEADER = struct.Struct('<4sIqI')
+SECTION = struct.Struct('<qqqqq')
+INT_SIZE = 8
+
+GRAPH_PATH = getattr(settings, 'ACTSTREAM_FOLLOW_GRAPH_PATH', None)
+GRAPH_CHECK_INTERVAL = getattr(settings,
+    'ACTSTREAM_FOLLOW_GRAPH_CHECK_INTERVAL', 1)
+
+
+def _pack_ints(values):
+    chunks = []
+    for start in range(0, len(values), 4096):
+        chunk = values[start:start + 4096]
+        chunks.append(struct.pack('<%dq' % len(chunk), *chunk))
+    return b''.join(chunks)
+
+
+def _intersect(first, second):
+    """
+    Intersection of two sorted sequences, as a sorted tuple.
+    """
+    result, i, j = [], 0, 0
+    while i < len(first) and j < len(second):
+        if first[i] < second[j]:
+            i += 1
+        elif first[i] > second[j]:
+            j += 1
+        else:
+            result.append(first[i])
+            i += 1
+            j += 1
+    return tuple(result)
+
+
+class _Adjacency(object):
+    """
+    Sorted keys mapping to sorted value lists, read straight from a buffer.
+    """
+
+    def __init__(self, buf, keys, values, offset):
+        self.buf = buf
+        self.keys = keys
+        self.keys_offset = offset
+        self.offsets_offset = offset + keys * INT_SIZE
+        self.values_offset = self.offsets_offset + (keys + 1) * INT_SIZE
+
+    def _int(self, offset, index):
+        return struct.unpack_from('<q', self.buf, offset + index * INT_SIZE)[0]
+
+    def _index(self, key):
+        low, high = 0, self.keys
+        while low < high:
+            middle = (low + high) // 2
+            if self._int(self.keys_offset, middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.keys and self._int(self.keys_offset, low) == key:
+            return low
+        return None
+
+    def all_keys(self):
+        return struct.unpack_from('<%dq' % self.keys, self.buf,
+            self.keys_offset)
+
+    def _range(self, key):
+        index = self._index(key)
+        if index is None:
+            return 0, 0
+        return struct.unpack_from('<2q', self.buf,
+            self.offsets_offset + index * INT_SIZE)
+
+    def get(self, key):
+        start, end = self._range(key)
+        return struct.unpack_from('<%dq' % (end - start), self.buf,
+            self.values_offset + start * INT_SIZE)
+
+    def contains(self, key, value):
+        low, high = self._range(key)
+        end = high
+        while low < high:
+            middle = (low + high) // 2
+            if self._int(self.values_offset, middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low < end and self._int(self.values_offset, low) == value
+
+
+class FollowGraph(object):
+    """
+    Read only follow graph answering followers-of, following-of, mutual
+    follow and intersection queries without touching the database.
+    """
+
+    def __init__(self, buf, path=None, mtime=None):
+        self.buf = buf
+        self.path = path
+        self.mtime = mtime
+        magic, version, self.user_content_type_id, count = \
+            HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a follow graph file: %r' % path)
+        self.sections = {}
+        for i in range(count):
+            content_type_id, kind, keys, values, offset = \
+                SECTION.unpack_from(buf, HEADER.size + i * SECTION.size)
+            self.sections[(content_type_id, kind)] = _Adjacency(buf, keys,
+                values, offset)
+
+    @classmethod
+    def serialize(cls, rows, user_content_type_id):
+        """
+        Returns the file contents for ``rows`` of ``(user_id,
+        content_type_id, object_id)`` integer triples.
+        """
+        adjacency = {}
+        for user_id, content_type_id, object_id in rows:
+            adjacency.setdefault((content_type_id, FOLLOWERS), {}).setdefault(
+                object_id, []).append(user_id)
+            adjacency.setdefault((content_type_id, FOLLOWING), {}).setdefault(
+                user_id, []).append(object_id)
+
+        headers, data = [], []
+        offset = HEADER.size + len(adjacency) * SECTION.size
+        for (content_type_id, kind), lists in sorted(adjacency.items()):
+            keys = sorted(lists)
+            offsets, values = [0], []
+            for key in keys:
+                values.extend(sorted(set(lists[key])))
+                offsets.append(len(values))
+            headers.append(SECTION.pack(content_type_id, kind, len(keys),
+                len(values), offset))
+            chunk = _pack_ints(keys) + _pack_ints(offsets) + \
+                _pack_ints(values)
+            data.append(chunk)
+            offset += len(chunk)
+        return HEADER.pack(MAGIC, VERSION, user_content_type_id,
+            len(adjacency)) + b''.join(headers) + b''.join(data)
+
+    @classmethod
+    def from_rows(cls, rows, user_content_type_id):
+        """
+        Builds an in-memory graph from ``(user_id, content_type_id,
+        object_id)`` triples.
+        """
+        return cls(cls.serialize(rows, user_content_type_id))
+
+    @classmethod
+    def write(cls, path, rows, user_content_type_id):
+        """
+        Writes a graph file atomically: readers see either the previous or
+        the new snapshot, never a partial one.
+        """
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        tmp = open(tmp_path, 'wb')
+        try:
+            tmp.write(cls.serialize(rows, user_content_type_id))
+        finally:
+            tmp.close()
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory maps the graph file at ``path``.
+        """
+        f = open(path, 'rb')
+        try:
+            mtime = os.fstat(f.fileno()).st_mtime
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        return cls(buf, path, mtime)
+
+    def content_type_ids(self):
+        """
+        Ids of the content types with at least one follow.
+        """
+        return sorted(set(content_type_id for content_type_id, kind in
+            self.sections))
+
+    def users(self):
+        """
+        Sorted ids of the users following anything.
+        """
+        users = set()
+        for (content_type_id, kind), section in self.sections.items():
+            if kind == FOLLOWING:
+                users.update(section.all_keys())
+        return sorted(users)
+
+    def followers(self, content_type_id, object_id):
+        """
+        Sorted ids of the users following the object.
+        """
+        section = self.sections.get((content_type_id, FOLLOWERS))
+        return section and section.get(object_id) or ()
+
+    def following(self, user_id, content_type_id):
+        """
+        Sorted ids of the objects of a content type the user follows.
+        """
+        section = self.sections.get((content_type_id, FOLLOWING))
+        return section and section.get(user_id) or ()
+
+    def is_following(self, user_id, content_type_id, object_id):
+        section = self.sections.get((content_type_id, FOLLOWING))
+        return bool(section and section.contains(user_id, object_id))
+
+    def is_mutual(self, user_id, other_user_id):
+        """
+        True if both users follow each other.
+        """
+        return self.is_following(user_id, self.user_content_type_id,
+            other_user_id) and self.is_following(other_user_id,
+                self.user_content_type_id, user_id)
+
+    def mutual(self, user_id):
+        """
+        Sorted ids of the users that follow ``user_id`` back.
+        """
+        return _intersect(self.following(user_id, self.user_content_type_id),
+            self.followers(self.user_content_type_id, user_id))
+
+    def common_followers(self, content_type_id, object_id, other_object_id):
+        """
+        Sorted ids of the users following both objects.
+        """
+        return _intersect(self.followers(content_type_id, object_id),
+            self.followers(content_type_id, other_object_id))
+
+    def common_following(self, user_id, other_user_id, content_type_id):
+        """
+        Sorted ids of the objects of a content type both users follow.
+        """
+        return _intersect(self.following(user_id, content_type_id),
+            self.following(other_user_id, content_type_id))
+
+
+_graph = {'instance': None, 'checked': 0}
+
+
+def get_follow_graph(path=None):
+    """
+    Returns the graph stored at ``path`` (``ACTSTREAM_FOLLOW_GRAPH_PATH`` by
+    default). The file is checked for a newer snapshot at most every
+    ``ACTSTREAM_FOLLOW_GRAPH_CHECK_INTERVAL`` seconds and swapped in without
+    interrupting readers of the old one. Returns None when no path is
+    configured or the snapshot has not been built yet.
+    """
+    path = path or GRAPH_PATH
+    if not path:
+        return None
+    graph, now = _graph['instance'], time()
+    if graph is not None and graph.path == path and \
+            now - _graph['checked'] < GRAPH_CHECK_INTERVAL:
+        return graph
+    _graph['checked'] = now
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        _graph['instance'] = None
+        return None
+    if graph is None or graph.path != path or mtime != graph.mtime:
+        _graph['instance'] = graph = FollowGraph.load(path)
+    return graph
+
+
+def follow_rows(chunk_size=10000):
+    """
+    Yields ``(user_id, content_type_id, object_id)`` triples from the
+    ``Follow`` table in primary key order, ``chunk_size`` rows per query.
+    Follows of objects without integer ids are skipped.
+    """
+    from actstream.gfk import int_object_id
+    from actstream.models import Follow
+
+    queryset = Follow.objects.order_by('pk').values_list('pk', 'user_id',
+        'content_type_id', 'object_id')
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+        if not rows:
+            break
+        for pk, user_id, content_type_id, object_id in rows:
+            object_id = int_object_id(object_id)
+            if object_id is not None:
+                yield user_id, content_type_id, object_id
+        last_pk = rows[-1][0]
@@ -0,0 +1,234 @@
+"""
+In-process publication of new actions to live clients.
+
+Public actions are published to the hub as they are created. Clients of the
+Server-Sent Events and long-poll views wait on the hub for the actions of
+their stream instead of querying the database, and resume from the cursor
+of the last action they received: the epoch of the hub, drawn at random when
+the process starts, and the sequence number of the action in that hub. A
+cursor from another process or from before a restart resumes from the
+current action.
+
+The hub only sees the actions created by the process it lives in: run the
+live views in the processes creating the actions or behind a single server
+process, with a threaded or evented server since every client holds a
+connection open.
+"""
+from collections import deque
+from random import getrandbits
+from threading import Condition, Lock
+from time import sleep, time
+
+from django.conf import settings
+from django.utils.encoding import smart_unicode
+
+LIVE = getattr(settings, 'ACTSTREAM_LIVE', False)
+LIVE_BUFFER = getattr(settings, 'ACTSTREAM_LIVE_BUFFER', 1000)
+LIVE_TIMEOUT = getattr(settings, 'ACTSTREAM_LIVE_TIMEOUT', 300)
+LIVE_POLL_TIMEOUT = getattr(settings, 'ACTSTREAM_LIVE_POLL_TIMEOUT', 25)
+LIVE_HEARTBEAT = getattr(settings, 'ACTSTREAM_LIVE_HEARTBEAT', 15)
+LIVE_PENDING_TIMEOUT = getattr(settings, 'ACTSTREAM_LIVE_PENDING_TIMEOUT', 10)
+
+ROLES = ('actor', 'target', 'action_object')
+PENDING_INTERVAL = 0.1
+
+
+class Event(object):
+    """
+    A published action: its sequence number in the hub, verb and the
+    ``(role, content type id, object id)`` and ``('model', content type
+    id)`` keys of the objects it refers to.
+    """
+
+    def __init__(self, sequence, action):
+        self.sequence = sequence
+        self.published = time()
+        self.lock = Lock()
+        self.next_attempt = 0
+        self.action_id = action.pk
+        self.verb = action.verb
+        self.keys = set()
+        for role in ROLES:
+            content_type_id = getattr(action, '%s_content_type_id' % role)
+            if content_type_id is not None:
+                self.keys.add((role, content_type_id, smart_unicode(
+                    getattr(action, '%s_object_id' % role))))
+                self.keys.add(('model', content_type_id))
+        self._item = None
+
+    def item(self):
+        """
+        The action in JSON Activity Streams format, serialized once for all
+        clients. None while the action is not committed yet: it is loaded
+        again at most every ``PENDING_INTERVAL`` seconds, whatever the
+        number of clients waiting for it.
+        """
+        if self._item is not None:
+            return self._item
+        self.lock.acquire()
+        try:
+            if self._item is None and time() >= self.next_attempt:
+                from actstream import activitystreams
+                from actstream.models import Action
+
+                self.next_attempt = time() + PENDING_INTERVAL
+                items = activitystreams.serialize(Action.objects.filter(
+                    pk=self.action_id))[0]['items']
+                if items:
+                    self._item = items[0]
+        finally:
+            self.lock.release()
+        return self._item
+
+    def expired(self):
+        """
+        True once a pending action was waited for
+        ``ACTSTREAM_LIVE_PENDING_TIMEOUT`` seconds, probably rolled back.
+        """
+        return time() - self.published >= LIVE_PENDING_TIMEOUT
+
+
+class Hub(object):
+    """
+    Keeps the last ``size`` published events and wakes up waiting clients.
+    """
+
+    def __init__(self, size=LIVE_BUFFER):
+        self.condition = Condition(Lock())
+        self.events = deque(maxlen=size)
+        self.sequence = 0
+        self.epoch = '%08x' % getrandbits(32)
+
+    def cursor(self, sequence):
+        """
+        Cursor of the ``sequence`` number for clients, unique across
+        processes and restarts.
+        """
+        return '%s-%d' % (self.epoch, sequence)
+
+    def parse_cursor(self, cursor):
+        """
+        Sequence number to wait after for a client cursor: the current one
+        for missing cursors, cursors of another epoch and sequence numbers
+        this hub has not reached.
+        """
+        try:
+            epoch, sequence = cursor.split('-', 1)
+            sequence = int(sequence)
+        except (AttributeError, ValueError):
+            return self.sequence
+        if epoch != self.epoch or not 0 <= sequence <= self.sequence:
+            return self.sequence
+        return sequence
+
+    def publish(self, action):
+        self.condition.acquire()
+        try:
+            self.sequence += 1
+            self.events.append(Event(self.sequence, action))
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def wait(self, after, matches, timeout):
+        """
+        Returns the events published after the ``after`` sequence number for
+        which ``matches(event)`` is true, and the sequence number to wait
+        after next time. Blocks for up to ``timeout`` seconds until there is
+        at least one.
+        """
+        deadline = time() + timeout
+        self.condition.acquire()
+        try:
+            while True:
+                events = [event for event in self.events
+                    if event.sequence > after and matches(event)]
+                after = max(after, self.sequence)
+                remaining = deadline - time()
+                if events or remaining <= 0:
+                    return events, after
+                self.condition.wait(remaining)
+        finally:
+            self.condition.release()
+
+    def read(self, after, matches, timeout):
+        """
+        Same as ``wait``, returning ``(event, item)`` pairs with the
+        serialized actions. An action that can not be loaded yet, saved in a
+        transaction that is not committed, holds back the events after it
+        until it is readable or ``ACTSTREAM_LIVE_PENDING_TIMEOUT`` seconds
+        have passed since it was published, after which it is skipped. The
+        event is shared by all clients, so the action is loaded once, not
+        once per client.
+        """
+        deadline = time() + timeout
+        while True:
+            events, next_after = self.wait(after, matches,
+                max(deadline - time(), 0))
+            ready, pending = [], False
+            for event in events:
+                item = event.item()
+                if item is not None:
+                    ready.append((event, item))
+                elif not event.expired():
+                    next_after, pending = event.sequence - 1, True
+                    break
+            if ready or time() >= deadline:
+                return ready, next_after
+            after = next_after
+            if pending:
+                sleep(min(PENDING_INTERVAL, max(deadline - time(), 0)))
+
+
+hub = Hub()
+
+
+def object_matcher(role, content_type_id, object_id):
+    """
+    Matches the actions where the object plays ``role``.
+    """
+    key = (role, int(content_type_id), smart_unicode(object_id))
+    return lambda event: key in event.keys
+
+
+def model_matcher(content_type_id):
+    """
+    Matches the actions referring to any object of the content type.
+    """
+    key = ('model', int(content_type_id))
+    return lambda event: key in event.keys
+
+
+def user_matcher(user):
+    """
+    Matches the actions of the stream of ``user``, from the follows of the
+    user at the time of the call.
+    """
+    from actstream.models import Follow
+
+    follows = {}
+    for follow in Follow.objects.filter(user=user):
+        for role in follow.get_roles():
+            follows[(role, follow.content_type_id,
+                smart_unicode(follow.object_id))] = follow.get_verbs()
+
+    def matches(event):
+        for key in event.keys:
+            if key in follows and (not follows[key] or
+                    event.verb in follows[key]):
+                return True
+        return False
+    return matches
+
+
+def action_published_handler(sender, instance=None, actions=(), created=True,
+        **kwargs):
+    """
+    Publishes new public actions, saved one by one or bulk created. Actions
+    without a primary key can not be loaded by the clients and are skipped.
+    """
+    if not created:
+        return
+    for action in (instance is not None and [instance] or actions):
+        if action.public and action.pk is not None:
+            hub.publish(action)
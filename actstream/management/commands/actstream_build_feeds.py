@@ -0,0 +1,148 @@
+import os
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.core.urlresolvers import resolve, reverse, NoReverseMatch
+from django.db import connection
+from django.db.models import Count
+from django.http import Http404
+from django.test.client import RequestFactory
+from django.contrib.contenttypes.models import ContentType
+
+from actstream import cache as actstream_cache, \
+    settings as actstream_settings
+from actstream.feeds import ActivityFeed, store_snapshot
+from actstream.models import Action
+
+MODEL_FEEDS = ('actstream_model_feed', 'actstream_model_feed_atom')
+OBJECT_FEEDS = ('actstream_object_feed', 'actstream_object_feed_atom',
+    'actstream_object_feed_as')
+
+
+class Command(NoArgsCommand):
+    help = ('Renders the model feeds and the feeds of the objects with the '
+        'most recent actions, and stores them as snapshots served by the feed '
+        'views (ACTSTREAM_FEED_SNAPSHOTS) or as static files.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--objects', type='int', dest='objects', default=100,
+            help='Number of object feeds to build, busiest objects first.'),
+        make_option('--days', type='int', dest='days', default=7,
+            help='Number of days of actions counted to find the busiest '
+                'objects.'),
+        make_option('--workers', type='int', dest='workers', default=4,
+            help='Number of feeds rendered in parallel.'),
+        make_option('--timeout', type='int', dest='timeout',
+            default=actstream_cache.FEED_SNAPSHOT_TIMEOUT,
+            help='Number of seconds snapshots are served for.'),
+        make_option('--output-dir', dest='output_dir', default=None,
+            help='Write the feeds to index.xml files under this directory, '
+                'one per feed URL, instead of the cache.'),
+    )
+
+    def handle_noargs(self, **options):
+        paths = self.model_paths() + self.object_paths(options['objects'],
+            options['days'])
+        build = lambda path: self.build(path, options)
+        if options['workers'] > 1:
+            pool = ThreadPool(options['workers'])
+            try:
+                built = pool.map(self.threaded(build), paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            built = map(build, paths)
+
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d of %d feeds built.\n' % (
+                len(filter(None, built)), len(paths)))
+
+    def model_paths(self):
+        paths = []
+        for model in actstream_settings.MODELS.values():
+            content_type_id = ContentType.objects.get_for_model(model).pk
+            paths.extend([reverse(name, None, (content_type_id,))
+                for name in MODEL_FEEDS])
+        return paths
+
+    def object_paths(self, count, days):
+        """
+        Feed paths of the ``count`` objects that were the action object of
+        the most public actions in the last ``days`` days.
+        """
+        busiest = Action.objects.filter(public=True,
+            timestamp__gte=datetime.now() - timedelta(days=days),
+            action_object_content_type__isnull=False).values_list(
+            'action_object_content_type', 'action_object_object_id').annotate(
+            actions=Count('id')).order_by('-actions')[:count]
+        paths = []
+        for content_type_id, object_id, actions in busiest:
+            try:
+                paths.extend([reverse(name, None, (content_type_id,
+                    object_id)) for name in OBJECT_FEEDS])
+            except NoReverseMatch:
+                continue
+        return paths
+
+    def threaded(self, func):
+        """
+        Closes the database connection of the worker thread after ``func``.
+        """
+        def wrapped(*args):
+            try:
+                return func(*args)
+            finally:
+                connection.close()
+        return wrapped
+
+    def build(self, path, options):
+        func, args, kwargs = resolve(path)
+        if not isinstance(func, ActivityFeed):
+            return False
+        request = self.request(path)
+        feed = func.for_request(request)
+        try:
+            obj = feed.get_object(request, *args, **kwargs)
+        except Http404:
+            return False
+        if options['output_dir']:
+            mime_type, content = feed.render(request, obj)
+            self.write(os.path.join(options['output_dir'], path.strip('/'),
+                'index.xml'), content)
+            return True
+        keys = feed.cache_versions(obj)
+        if keys is None:
+            return False
+        versions = actstream_cache.get_versions(keys)
+        etag, last_modified = feed.validators(obj)
+        mime_type, content = feed.render(request, obj)
+        store_snapshot(request, (mime_type, content, etag, last_modified), keys,
+            versions, options['timeout'])
+        return True
+
+    def request(self, path):
+        """
+        Request for ``path`` on the domain of the current ``Site`` with
+        ``ACTSTREAM_URL_SCHEME``, the host and scheme the feeds are served
+        from.
+        """
+        from django.contrib.sites.models import Site
+        return RequestFactory().get(path,
+            HTTP_HOST=Site.objects.get_current().domain,
+            **{'wsgi.url_scheme': actstream_settings.URL_SCHEME})
+
+    def write(self, filename, content):
+        if not os.path.isdir(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:   # Created by another worker
+                pass
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        tmp = open(tmp_filename, 'wb')
+        try:
+            tmp.write(content)
+        finally:
+            tmp.close()
+        os.rename(tmp_filename, filename)
@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+
+from actstream.graph import FollowGraph, GRAPH_PATH, follow_rows
+
+
+class Command(BaseCommand):
+    args = '[path]'
+    help = ('Writes a memory mappable snapshot of the Follow table to path '
+        '(ACTSTREAM_FOLLOW_GRAPH_PATH by default).')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=10000, help='Number of Follow rows read per query.'),
+    )
+
+    def handle(self, path=None, **options):
+        path = path or GRAPH_PATH
+        if not path:
+            raise CommandError('Give a path or set '
+                'ACTSTREAM_FOLLOW_GRAPH_PATH.')
+        rows = list(follow_rows(options['chunk_size']))
+        FollowGraph.write(path, rows,
+            ContentType.objects.get_for_model(User).pk)
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d follows written to %s\n' % (len(rows),
+                path))
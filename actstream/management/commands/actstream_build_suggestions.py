@@ -0,0 +1,82 @@
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Max
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+
+from actstream import suggestions
+from actstream.graph import FollowGraph, follow_rows
+from actstream.models import Follow
+
+# Shared with forked worker processes, see Command.score
+_state = {}
+
+
+def _score(user_id):
+    return user_id, suggestions.score_user(_state['graph'], user_id,
+        _state['limit'], _state['max_neighbors'])
+
+
+class Command(NoArgsCommand):
+    help = ('Scores friends-of-friends and co-follow suggestions for every '
+        'user and stores them in FollowSuggestion.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=10000, help='Number of Follow rows read per query.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=500, help='Number of users stored per transaction.'),
+        make_option('--limit', type='int', dest='limit', default=20,
+            help='Number of suggestions kept per user.'),
+        make_option('--max-neighbors', type='int', dest='max_neighbors',
+            default=100, help='Number of followed users and co-followers '
+                'expanded per user.'),
+        make_option('--processes', type='int', dest='processes', default=1,
+            help='Number of worker processes scoring users.'),
+        make_option('--since-id', type='int', dest='since_id', default=None,
+            help='Only refresh users affected by follows with a greater '
+                'primary key. Unfollows are not seen: run without it '
+                'regularly.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        last_id = Follow.objects.aggregate(last_id=Max('pk'))['last_id'] or 0
+        graph = FollowGraph.from_rows(follow_rows(options['chunk_size']),
+            ContentType.objects.get_for_model(User).pk)
+        if options['since_id'] is None:
+            users = graph.users()
+        else:
+            users = suggestions.affected_users(graph, options['since_id'])
+
+        _state.update(graph=graph, limit=options['limit'],
+            max_neighbors=options['max_neighbors'])
+        if options['processes'] > 1:
+            pool = Pool(options['processes'])
+            results = pool.imap_unordered(_score, users, 100)
+        else:
+            pool, results = None, (_score(user_id) for user_id in users)
+
+        batch, count = [], 0
+        for result in results:
+            batch.append(result)
+            if len(batch) >= options['batch_size']:
+                count += self.store(batch)
+                batch = []
+        count += self.store(batch)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if verbosity:
+            self.stdout.write('Suggestions refreshed for %d users. Pass '
+                '--since-id=%d to refresh incrementally next time.\n' % (
+                count, last_id))
+
+    @transaction.commit_on_success
+    def store(self, batch):
+        if batch:
+            suggestions.store(batch)
+        return len(batch)
@@ -0,0 +1,83 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils.encoding import smart_unicode
+from django.contrib.contenttypes.models import ContentType
+
+from actstream import registry
+from actstream.actions import prune_actions
+from actstream.gfk import has_integer_pk, int_object_id
+from actstream.models import Action
+
+
+class Command(NoArgsCommand):
+    help = ('Deletes (or hides) actions whose actor, target or action_object '
+        'no longer exists.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=1000, help='Number of object ids checked per query.'),
+        make_option('--tombstone', action='store_true', dest='tombstone',
+            default=False, help='Mark orphaned actions as not public instead '
+                'of deleting them.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Only count orphaned object references.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        total = 0
+        for field in ('actor', 'target', 'action_object'):
+            for ct_id in Action.objects.exclude(**{
+                    '%s_object_id' % field: None}).order_by().values_list(
+                    '%s_content_type' % field, flat=True).distinct():
+                for missing in self.orphans(field, ct_id,
+                        options['chunk_size']):
+                    if options['dry_run']:
+                        count = len(missing)
+                    else:
+                        count = prune_actions(ct_id, missing,
+                            tombstone=options['tombstone'])
+                    total += count
+                    if verbosity > 1:
+                        self.stdout.write('%s content type %s: %d\n' % (
+                            field, ct_id, count))
+        if verbosity:
+            if options['dry_run']:
+                self.stdout.write('%d orphaned objects found\n' % total)
+            else:
+                self.stdout.write('%d orphaned actions pruned\n' % total)
+
+    def orphans(self, field, ct_id, chunk_size):
+        """
+        Yields lists of the object ids of content type ``ct_id`` that actions
+        refer to as ``field`` but that no longer exist, one chunk at a time.
+        """
+        try:
+            model = registry.get_model_class(ct_id)
+        except ContentType.DoesNotExist:
+            model = None
+        fk_field = '%s_object_id' % field
+        object_ids = Action.objects.filter(**{
+            '%s_content_type' % field: ct_id}).exclude(**{fk_field: None})\
+            .order_by(fk_field).values_list(fk_field, flat=True).distinct()
+        last_id = None
+        while True:
+            chunk = object_ids
+            if last_id is not None:
+                chunk = chunk.filter(**{'%s__gt' % fk_field: last_id})
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1]
+            if model is None:
+                yield chunk
+                continue
+            lookup_ids = chunk
+            if has_integer_pk(model):
+                lookup_ids = filter(lambda pk: pk is not None,
+                    map(int_object_id, chunk))
+            existing = set(map(smart_unicode, model._default_manager.filter(
+                pk__in=lookup_ids).values_list('pk', flat=True)))
+            missing = [pk for pk in chunk if not smart_unicode(pk) in existing]
+            if missing:
+                yield missing
@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from actstream.models import FollowCounter
+
+
+class Command(NoArgsCommand):
+    help = 'Recomputes the follower and following counters from Follow.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        count = FollowCounter.objects.rebuild()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d follow counters rebuilt\n' % count)
@@ -0,0 +1,40 @@
+from optparse import make_option
+from time import sleep
+
+from django.core.management.base import NoArgsCommand
+
+from actstream import webhooks
+
+
+class Command(NoArgsCommand):
+    help = ('Sends the due webhook deliveries in batches, one request per '
+        'subscription, and reschedules failed ones with exponential backoff.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=webhooks.WEBHOOK_BATCH_SIZE,
+            help='Number of deliveries sent per round.'),
+        make_option('--loop', action='store_true', dest='loop',
+            default=False, help='Keep running and wait for new deliveries.'),
+        make_option('--interval', type='float', dest='interval', default=5,
+            help='Number of seconds to wait between rounds with --loop when '
+                'nothing is due.'),
+    )
+
+    def handle_noargs(self, **options):
+        pool = webhooks.ConnectionPool()
+        total = [0, 0, 0]
+        try:
+            while True:
+                counts = webhooks.deliver(pool, options['batch_size'])
+                total = [a + b for a, b in zip(total, counts)]
+                if sum(counts):
+                    continue
+                if not options['loop']:
+                    break
+                sleep(options['interval'])
+        finally:
+            pool.close()
+
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d deliveries sent, %d failed, %d dropped.\n'
+                % tuple(total))
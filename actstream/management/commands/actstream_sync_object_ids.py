@@ -0,0 +1,86 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.contrib.contenttypes.generic import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+
+from actstream import registry
+from actstream.gfk import has_integer_pk, int_object_id, int_field_name
+from actstream.models import Action, Follow
+
+
+class Command(NoArgsCommand):
+    help = ('Fills in the typed integer object id columns of existing '
+        'actions and follows. Run once before enabling '
+        'ACTSTREAM_INT_OBJECT_IDS.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=1000, help='Number of rows updated per transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in (Action, Follow):
+            for gfk in model._meta.virtual_fields:
+                if not isinstance(gfk, GenericForeignKey):
+                    continue
+                updated = self.sync(model, gfk, options['chunk_size'])
+                if verbosity:
+                    self.stdout.write('%s.%s: %d rows updated\n' % (
+                        model.__name__, int_field_name(gfk.fk_field),
+                        updated))
+
+    def sync(self, model, gfk, chunk_size):
+        int_field = int_field_name(gfk.fk_field)
+        manager = model._default_manager
+        ct_ids = manager.exclude(**{gfk.fk_field: None}).order_by()\
+            .values_list(gfk.ct_field, flat=True).distinct()
+        updated = 0
+        for ct_id in ct_ids:
+            try:
+                if not has_integer_pk(registry.get_model_class(ct_id)):
+                    continue
+            except ContentType.DoesNotExist:
+                continue
+            queryset = manager.filter(**{gfk.ct_field: ct_id,
+                int_field: None}).exclude(**{gfk.fk_field: None})\
+                .order_by('pk')
+            last_pk = 0
+            while True:
+                rows = list(queryset.filter(pk__gt=last_pk).values_list(
+                    'pk', gfk.fk_field)[:chunk_size])
+                if not rows:
+                    break
+                updated += self.update_chunk(model, gfk, ct_id, rows)
+                last_pk = rows[-1][0]
+        return updated
+
+    @transaction.commit_on_success
+    def update_chunk(self, model, gfk, ct_id, rows):
+        """
+        Copies the character object ids of ``rows`` into the integer column
+        with a single ``UPDATE``, skipping ids that are not plain integers.
+        """
+        opts = model._meta
+        qn = connection.ops.quote_name
+        column = qn(opts.get_field(gfk.fk_field).column)
+        int_column = qn(opts.get_field(int_field_name(gfk.fk_field)).column)
+        pk_column = qn(opts.pk.column)
+        skipped = [pk for pk, object_id in rows
+            if int_object_id(object_id) is None]
+        sql = ('UPDATE %s SET %s = CAST(%s AS %s) WHERE %s = %%s AND '
+            '%s >= %%s AND %s <= %%s AND %s IS NULL AND %s IS NOT NULL' % (
+            qn(opts.db_table), int_column, column,
+            connection.vendor == 'mysql' and 'SIGNED' or 'BIGINT',
+            qn(opts.get_field(gfk.ct_field).column), pk_column, pk_column,
+            int_column, column))
+        params = [ct_id, rows[0][0], rows[-1][0]]
+        if skipped:
+            sql += ' AND %s NOT IN (%s)' % (pk_column,
+                ', '.join(['%s'] * len(skipped)))
+            params.extend(skipped)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        transaction.set_dirty()
+        return cursor.rowcount
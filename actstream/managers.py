@@ -1,10 +1,13 @@
 from collections import defaultdict
 
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, F, Count
+from django.utils.encoding import smart_unicode
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 
-from actstream.gfk import GFKManager
+from actstream import registry
+from actstream.gfk import GFKManager, object_id_lookup
 from actstream.decorators import stream
 
 
@@ -13,6 +16,31 @@ class ActionManager(GFKManager):
     Default manager for Actions, accessed through Action.objects
     """
 
+    def _object_q(self, field, content_type_id, object_ids):
+        """
+        Q object matching actions where ``field`` (actor, target or
+        action_object) is one of ``object_ids`` of the given content type.
+        """
+        lookup = object_id_lookup(self.model, '%s_object_id' % field,
+            registry.get_model_class(content_type_id, self.db), object_ids)
+        lookup['%s_content_type' % field] = content_type_id
+        return Q(**lookup)
+
+    def _instance_q(self, field, object):
+        return self._object_q(field,
+            ContentType.objects.get_for_model(object).pk, [object.pk])
+
+    def referencing(self, content_type_id, object_ids,
+            fields=('actor', 'target', 'action_object')):
+        """
+        Actions that refer to any of ``object_ids`` of the given content type
+        as one of ``fields``.
+        """
+        q = Q()
+        for field in fields:
+            q = q | self._object_q(field, content_type_id, object_ids)
+        return self.filter(q)
+
     def public(self, *args, **kwargs):
         """
         Only return public actions
@@ -26,7 +54,7 @@ class ActionManager(GFKManager):
         Stream of most recent actions where object is the actor.
         Keyword arguments will be passed to Action.objects.filter
         """
-        return object.actor_actions.public(**kwargs)
+        return self.public(self._instance_q('actor', object), **kwargs)
 
     @stream
     def target(self, object, **kwargs):
@@ -34,7 +62,7 @@ class ActionManager(GFKManager):
         Stream of most recent actions where object is the target.
         Keyword arguments will be passed to Action.objects.filter
         """
-        return object.target_actions.public(**kwargs)
+        return self.public(self._instance_q('target', object), **kwargs)
 
     @stream
     def action_object(self, object, **kwargs):
@@ -42,7 +70,24 @@ class ActionManager(GFKManager):
         Stream of most recent actions where object is the action_object.
         Keyword arguments will be passed to Action.objects.filter
         """
-        return object.action_object_actions.public(**kwargs)
+        return self.public(self._instance_q('action_object', object), **kwargs)
+
+    @stream
+    def action_objects(self, objects, **kwargs):
+        """
+        Stream of most recent actions where the action_object is any of
+        ``objects``, a list of ``(content_type_id, object_id)`` pairs, merged
+        into a single query.
+        """
+        object_ids = defaultdict(lambda: [])
+        for content_type_id, object_id in objects:
+            object_ids[content_type_id].append(object_id)
+        if not object_ids:
+            return self.none()
+        q = Q()
+        for content_type_id, ids in object_ids.iteritems():
+            q = q | self._object_q('action_object', content_type_id, ids)
+        return self.public(q, **kwargs)
 
     @stream
     def model_actions(self, model, **kwargs):
@@ -61,38 +106,33 @@ class ActionManager(GFKManager):
     def user(self, object, **kwargs):
         """
         Stream of most recent actions by objects that the passed User object is
-        following.
+        following, limited to the verbs and roles of each follow.
         """
-        from actstream.models import Follow
+        from actstream.models import Follow, ROLES, split_list
         q = Q()
         qs = self.filter(public=True)
-        actors_by_content_type = defaultdict(lambda: [])
-        others_by_content_type = defaultdict(lambda: [])
+        object_ids = defaultdict(lambda: [])
 
         follow_gfks = Follow.objects.filter(user=object).values_list(
-            'content_type_id', 'object_id', 'actor_only')
+            'content_type_id', 'object_id', 'actor_only', 'verbs', 'roles')
 
         if not follow_gfks:
             return qs.none()
 
-        for content_type_id, object_id, actor_only in follow_gfks.iterator():
-            actors_by_content_type[content_type_id].append(object_id)
-            if not actor_only:
-                others_by_content_type[content_type_id].append(object_id)
-
-        for content_type_id, object_ids in actors_by_content_type.iteritems():
-            q = q | Q(
-                actor_content_type=content_type_id,
-                actor_object_id__in=object_ids,
-            )
-        for content_type_id, object_ids in others_by_content_type.iteritems():
-            q = q | Q(
-                target_content_type=content_type_id,
-                target_object_id__in=object_ids,
-            ) | Q(
-                action_object_content_type=content_type_id,
-                action_object_object_id__in=object_ids,
-            )
+        # Follows sharing a content type, role and verb filter become a
+        # single indexed lookup
+        for content_type_id, object_id, actor_only, verbs, roles in \
+                follow_gfks.iterator():
+            roles = split_list(roles) or (actor_only and ['actor'] or ROLES)
+            verbs = tuple(sorted(split_list(verbs)))
+            for role in roles:
+                object_ids[(content_type_id, role, verbs)].append(object_id)
+
+        for (content_type_id, role, verbs), ids in object_ids.iteritems():
+            object_q = self._object_q(role, content_type_id, ids)
+            if verbs:
+                object_q = object_q & Q(verb__in=verbs)
+            q = q | object_q
         qs = qs.filter(q, **kwargs)
         return qs
 
@@ -107,13 +147,135 @@ class FollowManager(GFKManager):
         Filter to a specific instance.
         """
         content_type = ContentType.objects.get_for_model(instance).pk
-        return self.filter(content_type=content_type, object_id=instance.pk)
+        return self.filter(content_type=content_type, **object_id_lookup(
+            self.model, 'object_id', instance.__class__, [instance.pk]))
 
     def is_following(self, user, instance):
         """
         Check if a user is following an instance.
         """
+        from actstream import bloom
+
         if not user or user.is_anonymous():
             return False
+        if bloom.FOLLOW_BLOOM and not bloom.might_follow(user,
+                ContentType.objects.get_for_model(instance).pk, instance.pk):
+            return False
         queryset = self.for_object(instance)
         return queryset.filter(user=user).exists()
+
+    def followers_page(self, instance, after=None, limit=50):
+        """
+        Returns up to ``limit`` users following ``instance`` and the cursor
+        of the next page (None on the last page). Users are loaded with the
+        follows in a single query, in the order they started following.
+        Pass the returned cursor as ``after`` to get the next page.
+        """
+        queryset = self.for_object(instance).select_related('user')\
+            .order_by('pk')
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        follows = list(queryset[:limit + 1])
+        cursor = None
+        if len(follows) > limit:
+            follows = follows[:limit]
+            cursor = follows[-1].pk
+        return [follow.user for follow in follows], cursor
+
+    def following_keys(self, user):
+        """
+        Returns the set of ``(content_type_id, object_id)`` pairs ``user`` is
+        following, loaded with a single query.
+        """
+        return set((content_type_id, smart_unicode(object_id)) for
+            content_type_id, object_id in self.filter(user=user).values_list(
+                'content_type_id', 'object_id').iterator())
+
+
+class FollowCounterManager(models.Manager):
+    """
+    Manager for FollowCounter model.
+    """
+
+    def counter(self, content_type_id, object_id):
+        """
+        Returns the counter of an object, creating it from the ``Follow``
+        table if it does not exist yet.
+        """
+        from actstream.models import Follow
+
+        try:
+            return self.get(content_type=content_type_id, object_id=object_id)
+        except self.model.DoesNotExist:
+            pass
+        following = 0
+        if content_type_id == ContentType.objects.get_for_model(User).pk:
+            following = Follow.objects.filter(user=object_id).count()
+        return self.get_or_create(content_type=registry.get_content_type(
+            content_type_id, self.db), object_id=object_id, defaults={
+                'followers': Follow.objects.filter(
+                    content_type=content_type_id,
+                    object_id=object_id).count(),
+                'following': following,
+            })[0]
+
+    def followers(self, instance):
+        """
+        Number of users following ``instance``.
+        """
+        return self.counter(ContentType.objects.get_for_model(instance).pk,
+            smart_unicode(instance.pk)).followers
+
+    def following(self, user):
+        """
+        Number of objects ``user`` is following.
+        """
+        return self.counter(ContentType.objects.get_for_model(user).pk,
+            smart_unicode(user.pk)).following
+
+    def adjust(self, content_type_id, object_id, field, delta):
+        """
+        Atomically adds ``delta`` to the ``field`` count of an object. Counts
+        never go below zero, even if they drifted from the ``Follow`` table.
+        """
+        object_id = smart_unicode(object_id)
+        counters = self.filter(content_type=content_type_id,
+            object_id=object_id)
+        if delta >= 0:
+            updated = counters.update(**{field: F(field) + delta})
+        else:
+            updated = counters.filter(**{'%s__gte' % field: -delta}).update(
+                **{field: F(field) + delta}) or counters.update(**{field: 0})
+        if not updated:
+            # Missing counters are created from the current Follow rows,
+            # which already include this change.
+            self.counter(content_type_id, object_id)
+
+    def rebuild(self):
+        """
+        Recomputes every counter from the ``Follow`` table.
+        """
+        from actstream.models import Follow
+
+        counts = {}
+        for row in Follow.objects.order_by().values('content_type',
+                'object_id').annotate(count=Count('id')):
+            key = (row['content_type'], smart_unicode(row['object_id']))
+            counts.setdefault(key, [0, 0])[0] = row['count']
+        user_ct = ContentType.objects.get_for_model(User).pk
+        for row in Follow.objects.order_by().values('user').annotate(
+                count=Count('id')):
+            key = (user_ct, smart_unicode(row['user']))
+            counts.setdefault(key, [0, 0])[1] = row['count']
+
+        self.all().delete()
+        counters = [self.model(content_type_id=content_type_id,
+            object_id=object_id, followers=followers, following=following)
+            for (content_type_id, object_id), (followers, following)
+            in counts.iteritems()]
+        if hasattr(self, 'bulk_create'):
+            self.bulk_create(counters)
+        else:
+            for counter in counters:
+                counter.save()
+        return len(counters)
@@ -1,16 +1,45 @@
 from datetime import datetime
 
-from django.db import models
-from django.core.urlresolvers import reverse
+from django.db import models, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete
+from django.core.signals import request_finished
 from django.utils.translation import ugettext as _
 
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
 
-from actstream import managers, settings as actstream_settings
-from actstream.signals import action
-from actstream.actions import action_handler
+from actstream import managers, live, urlcache, webhooks, \
+    settings as actstream_settings, cache as actstream_cache
+from actstream.gfk import GFKManager, sync_int_object_ids
+from actstream.signals import action, actions_bulk_created
+from actstream.actions import action_handler, prune_deleted_object, \
+    follow_counters_handler, follow_counters_prune_handler, \
+    follow_suggestions_handler
+
+
+# Roles an object can play in an action, see Follow.roles
+ROLES = ('actor', 'target', 'action_object')
+
+
+def split_list(value):
+    """
+    Splits a comma separated ``Follow.verbs`` or ``Follow.roles`` value.
+    """
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def join_list(values, choices=None):
+    """
+    Joins ``values`` into a comma separated ``Follow.verbs`` or
+    ``Follow.roles`` value. Raises ``ValueError`` for values not in
+    ``choices`` or containing a comma.
+    """
+    values = [unicode(value).strip() for value in values or ()]
+    for value in values:
+        if u',' in value or (choices is not None and not value in choices):
+            raise ValueError('Invalid follow filter %r' % value)
+    return u','.join(sorted(set(values)))
 
 
 class Follow(models.Model):
@@ -21,9 +50,16 @@ class Follow(models.Model):
 
     content_type = models.ForeignKey(ContentType)
     object_id = models.CharField(max_length=255)
+    object_id_int = models.BigIntegerField(blank=True, null=True,
+        db_index=True, editable=False)
     follow_object = generic.GenericForeignKey()
     actor_only = models.BooleanField("Only follow actions where the object is "
         "the target.", default=True)
+    verbs = models.CharField(max_length=255, blank=True, default='',
+        help_text="Comma separated verbs to follow, all verbs if empty.")
+    roles = models.CharField(max_length=50, blank=True, default='',
+        help_text="Comma separated roles (actor, target, action_object) the "
+        "object must play, decided by actor_only if empty.")
     objects = managers.FollowManager()
 
     class Meta:
@@ -32,6 +68,67 @@ class Follow(models.Model):
     def __unicode__(self):
         return u'%s -> %s' % (self.user, self.follow_object)
 
+    def save(self, *args, **kwargs):
+        sync_int_object_ids(self)
+        super(Follow, self).save(*args, **kwargs)
+
+    def get_verbs(self):
+        """
+        The verbs this follow is limited to, an empty list for all verbs.
+        """
+        return split_list(self.verbs)
+
+    def get_roles(self):
+        """
+        The roles (actor, target, action_object) the followed object must
+        play in an action for it to show up in the user's stream.
+        """
+        return split_list(self.roles) or (self.actor_only and ['actor'] or
+            list(ROLES))
+
+
+class FollowCounter(models.Model):
+    """
+    Denormalized number of followers of any object and, for users, the number
+    of objects they follow
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.CharField(max_length=255)
+    followers = models.PositiveIntegerField(default=0)
+    following = models.PositiveIntegerField(default=0)
+
+    objects = managers.FollowCounterManager()
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
+    def __unicode__(self):
+        return u'%s:%s (%d followers, %d following)' % (self.content_type_id,
+            self.object_id, self.followers, self.following)
+
+
+class FollowSuggestion(models.Model):
+    """
+    Precomputed object a user may want to follow, scored offline by the
+    ``actstream_build_suggestions`` command
+    """
+    user = models.ForeignKey(User)
+
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.CharField(max_length=255)
+    suggested_object = generic.GenericForeignKey()
+    score = models.FloatField()
+
+    objects = GFKManager()
+
+    class Meta:
+        ordering = ('user', '-score')
+        unique_together = ('user', 'content_type', 'object_id')
+
+    def __unicode__(self):
+        return u'%s -> %s (%.2f)' % (self.user, self.suggested_object,
+            self.score)
+
 
 class Action(models.Model):
     """
@@ -64,14 +161,18 @@ class Action(models.Model):
     """
     actor_content_type = models.ForeignKey(ContentType, related_name='actor')
     actor_object_id = models.CharField(max_length=255)
+    actor_object_id_int = models.BigIntegerField(blank=True, null=True,
+        db_index=True, editable=False)
     actor = generic.GenericForeignKey('actor_content_type', 'actor_object_id')
 
-    verb = models.CharField(max_length=255)
+    verb = models.CharField(max_length=255, db_index=True)
     description = models.TextField(blank=True, null=True)
 
     target_content_type = models.ForeignKey(ContentType, related_name='target',
         blank=True, null=True)
     target_object_id = models.CharField(max_length=255, blank=True, null=True)
+    target_object_id_int = models.BigIntegerField(blank=True, null=True,
+        db_index=True, editable=False)
     target = generic.GenericForeignKey('target_content_type',
         'target_object_id')
 
@@ -79,6 +180,8 @@ class Action(models.Model):
         related_name='action_object', blank=True, null=True)
     action_object_object_id = models.CharField(max_length=255, blank=True,
         null=True)
+    action_object_object_id_int = models.BigIntegerField(blank=True,
+        null=True, db_index=True, editable=False)
     action_object = generic.GenericForeignKey('action_object_content_type',
         'action_object_object_id')
 
@@ -107,26 +210,30 @@ class Action(models.Model):
             return _('%(actor)s %(verb)s %(action_object)s %(timesince)s ago') % ctx
         return _('%(actor)s %(verb)s %(timesince)s ago') % ctx
 
+    def save(self, *args, **kwargs):
+        sync_int_object_ids(self)
+        super(Action, self).save(*args, **kwargs)
+
     def actor_url(self):
         """
         Returns the URL to the ``actstream_actor`` view for the current actor.
         """
-        return reverse('actstream_actor', None,
-                       (self.actor_content_type.pk, self.actor_object_id))
+        return urlcache.reverse('actstream_actor',
+            (self.actor_content_type_id, self.actor_object_id))
 
     def target_url(self):
         """
         Returns the URL to the ``actstream_actor`` view for the current target.
         """
-        return reverse('actstream_actor', None,
-                       (self.target_content_type.pk, self.target_object_id))
+        return urlcache.reverse('actstream_actor',
+            (self.target_content_type_id, self.target_object_id))
 
     def action_object_url(self):
         """
         Returns the URL to the ``actstream_action_object`` view for the current action object
         """
-        return reverse('actstream_actor', None,
-            (self.action_object_content_type.pk, self.action_object_object_id))
+        return urlcache.reverse('actstream_actor',
+            (self.action_object_content_type_id, self.action_object_object_id))
 
     def timesince(self, now=None):
         """
@@ -141,23 +248,80 @@ class Action(models.Model):
         return ('actstream.views.detail', [self.pk])
 
 
+class WebhookSubscription(models.Model):
+    """
+    URL receiving new public actions, optionally limited to some verbs, in
+    batches sent by the ``actstream_send_webhooks`` command
+    """
+    url = models.URLField(max_length=255)
+    verbs = models.CharField(max_length=255, blank=True, default='')
+    secret = models.CharField(max_length=255, blank=True, default='')
+    active = models.BooleanField(default=True)
+
+    def __unicode__(self):
+        return self.url
+
+    def get_verbs(self):
+        """
+        The verbs this subscription is limited to, an empty list for all verbs.
+        """
+        return split_list(self.verbs)
+
+
+class WebhookDelivery(models.Model):
+    """
+    Outbox entry of an action to send to a webhook subscription. Entries are
+    deleted once delivered and have no ``next_attempt`` once given up on.
+    """
+    subscription = models.ForeignKey(WebhookSubscription,
+        related_name='deliveries')
+    action = models.ForeignKey(Action)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=datetime.now, blank=True,
+        null=True, db_index=True)
+    last_error = models.TextField(blank=True, default='')
+
+    def __unicode__(self):
+        return u'%s -> %s' % (self.action_id, self.subscription)
+
+
 # convenient accessors
 actor_stream = Action.objects.actor
 action_object_stream = Action.objects.action_object
+action_objects_stream = Action.objects.action_objects
 target_stream = Action.objects.target
 user_stream = Action.objects.user
 model_stream = Action.objects.model_actions
 
 
+class ActionRelation(generic.GenericRelation):
+    """
+    Relation from an actionable model to its actions. Deleting an object
+    cascades to its actions unless ``ACTSTREAM_PRUNE_ON_DELETE`` is set, in
+    which case ``prune_deleted_object`` deletes or hides them with a single
+    query once the object is gone.
+    """
+
+    def bulk_related_objects(self, objs, using=DEFAULT_DB_ALIAS):
+        if actstream_settings.PRUNE_ON_DELETE:
+            return self.rel.to._base_manager.db_manager(using).none()
+        return super(ActionRelation, self).bulk_related_objects(objs, using)
+
+
 def setup_generic_relations():
     """
-    Set up GenericRelations for actionable models.
+    Set up GenericRelations for actionable models. Relations already set up
+    are left alone, so the function can be called again when models are
+    registered later.
     """
     for model in actstream_settings.MODELS.values():
         if not model:
             continue
+        existing = [f.name for f in model._meta.local_many_to_many]
         for field in ('actor', 'target', 'action_object'):
-            generic.GenericRelation(Action,
+            if '%s_actions' % field in existing:
+                continue
+            ActionRelation(Action,
                 content_type_field='%s_content_type' % field,
                 object_id_field='%s_object_id' % field,
                 related_name='actions_with_%s_%s_as_%s' % (
@@ -173,3 +337,49 @@ setup_generic_relations()
 
 # connect the signal
 action.connect(action_handler, dispatch_uid='actstream.models')
+
+post_save.connect(follow_counters_handler, sender=Follow,
+    dispatch_uid='actstream.models.follow_counters')
+post_delete.connect(follow_counters_handler, sender=Follow,
+    dispatch_uid='actstream.models.follow_counters')
+post_delete.connect(follow_counters_prune_handler,
+    dispatch_uid='actstream.models.follow_counters_prune')
+post_save.connect(follow_suggestions_handler, sender=Follow,
+    dispatch_uid='actstream.models.follow_suggestions')
+
+post_save.connect(actstream_cache.follow_versions_handler, sender=Follow,
+    dispatch_uid='actstream.models.follow_versions')
+post_delete.connect(actstream_cache.follow_versions_handler, sender=Follow,
+    dispatch_uid='actstream.models.follow_versions')
+request_finished.connect(actstream_cache.flush_follow_versions,
+    dispatch_uid='actstream.models.follow_versions')
+
+if actstream_cache.FEED_CACHE or actstream_cache.FEED_SNAPSHOTS:
+    post_save.connect(actstream_cache.action_versions_handler, sender=Action,
+        dispatch_uid='actstream.models.action_versions')
+    post_delete.connect(actstream_cache.action_versions_handler,
+        sender=Action, dispatch_uid='actstream.models.action_versions')
+    actions_bulk_created.connect(actstream_cache.action_versions_handler,
+        sender=Action, dispatch_uid='actstream.models.action_versions')
+
+if actstream_cache.ACTION_CACHE:
+    post_save.connect(actstream_cache.object_versions_handler,
+        dispatch_uid='actstream.models.object_versions')
+    post_delete.connect(actstream_cache.object_versions_handler,
+        dispatch_uid='actstream.models.object_versions')
+
+if live.LIVE:
+    post_save.connect(live.action_published_handler, sender=Action,
+        dispatch_uid='actstream.models.live')
+    actions_bulk_created.connect(live.action_published_handler,
+        sender=Action, dispatch_uid='actstream.models.live')
+
+if webhooks.WEBHOOKS:
+    post_save.connect(webhooks.enqueue_handler, sender=Action,
+        dispatch_uid='actstream.models.webhooks')
+    actions_bulk_created.connect(webhooks.enqueue_handler, sender=Action,
+        dispatch_uid='actstream.models.webhooks')
+
+if actstream_settings.PRUNE_ON_DELETE:
+    post_delete.connect(prune_deleted_object,
+        dispatch_uid='actstream.models.prune')
@@ -0,0 +1,92 @@
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete
+from django.http import Http404
+from django.contrib.contenttypes.models import ContentType
+
+# Process wide mapping of database alias -> {content type id: ContentType}
+_content_types = {}
+
+
+def warm(using=DEFAULT_DB_ALIAS):
+    """
+    Loads every ``ContentType`` in the ``using`` database into the registry
+    with a single query. Called automatically on the first lookup.
+    """
+    _content_types[using] = dict((ct.pk, ct) for ct in
+        ContentType.objects.using(using).all())
+    return _content_types[using]
+
+
+def clear(**kwargs):
+    """
+    Empties the registry. Connected to ``ContentType`` saves and deletes so
+    that the next lookup reloads the table.
+    """
+    _content_types.clear()
+
+
+def load_content_types(ids, using=DEFAULT_DB_ALIAS):
+    """
+    Same as ``get_content_types``, returning the number of queries run to
+    fill the registry along with the dictionary.
+    """
+    queries = 0
+    registry = _content_types.get(using)
+    if registry is None:
+        registry = warm(using)
+        queries += 1
+    missing = [pk for pk in ids if not pk in registry]
+    if missing:
+        registry.update(ContentType.objects.using(using).in_bulk(missing))
+        queries += 1
+    return dict((pk, registry[pk]) for pk in ids if pk in registry), queries
+
+
+def get_content_types(ids, using=DEFAULT_DB_ALIAS):
+    """
+    Returns a dictionary of ``ContentType`` instances keyed by id, just like
+    ``ContentType.objects.in_bulk(ids)``, without querying the database
+    once the registry is warm.
+    """
+    return load_content_types(ids, using)[0]
+
+
+def get_content_type(content_type_id, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the ``ContentType`` for ``content_type_id`` from the registry.
+    Raises ``ContentType.DoesNotExist`` for unknown ids.
+    """
+    try:
+        content_type_id = int(content_type_id)
+    except (TypeError, ValueError):
+        raise ContentType.DoesNotExist('Invalid content type id %r' %
+            content_type_id)
+    try:
+        return get_content_types([content_type_id], using)[content_type_id]
+    except KeyError:
+        raise ContentType.DoesNotExist('No content type with id %r' %
+            content_type_id)
+
+
+def get_model_class(content_type_id, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the model class for ``content_type_id`` from the registry.
+    """
+    return get_content_type(content_type_id, using).model_class()
+
+
+def get_content_type_or_404(content_type_id, using=DEFAULT_DB_ALIAS):
+    """
+    Registry backed replacement for
+    ``get_object_or_404(ContentType, pk=content_type_id)``.
+    """
+    try:
+        return get_content_type(content_type_id, using)
+    except ContentType.DoesNotExist:
+        raise Http404('No ContentType matches the given query.')
+
+
+post_save.connect(clear, sender=ContentType,
+    dispatch_uid='actstream.registry.clear')
+post_delete.connect(clear, sender=ContentType,
+    dispatch_uid='actstream.registry.clear')
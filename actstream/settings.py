@@ -27,3 +27,15 @@ MANAGER_MODULE = getattr(settings, 'ACTSTREAM_MANAGER',
     'actstream.managers.ActionManager')
 a, j = MANAGER_MODULE.split('.'), lambda l: '.'.join(l)
 MANAGER_MODULE = getattr(__import__(j(a[:-1]), {}, {}, [a[-1]]), a[-1])
+
+PRUNE_ON_DELETE = getattr(settings, 'ACTSTREAM_PRUNE_ON_DELETE', False)
+
+FOLLOWERS_PAGE_SIZE = getattr(settings, 'ACTSTREAM_FOLLOWERS_PAGE_SIZE', 50)
+
+FEED_ITEMS = getattr(settings, 'ACTSTREAM_FEED_ITEMS', 30)
+
+FEED_MAX_OBJECTS = getattr(settings, 'ACTSTREAM_FEED_MAX_OBJECTS', 100)
+
+JSON_PAGE_SIZE = getattr(settings, 'ACTSTREAM_JSON_PAGE_SIZE', 20)
+
+URL_SCHEME = getattr(settings, 'ACTSTREAM_URL_SCHEME', 'http')
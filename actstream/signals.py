@@ -2,3 +2,7 @@ from django.dispatch import Signal
 
 action = Signal(providing_args=['actor', 'verb', 'action_object', 'target',
     'description', 'timestamp'])
+
+generic_relations_fetched = Signal(providing_args=['stats'])
+
+actions_bulk_created = Signal(providing_args=['actions'])
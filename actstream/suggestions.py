@@ -0,0 +1,98 @@
+"""
+Offline scoring of follow suggestions.
+
+Candidates for a user are scored from two signals of the follow graph:
+
+* friends of friends: objects followed by the users the user follows
+  (``ACTSTREAM_SUGGESTIONS_FOF_WEIGHT``, default ``1.0`` per path)
+* co-follows: objects followed by other followers of the objects the user
+  follows (``ACTSTREAM_SUGGESTIONS_COFOLLOW_WEIGHT``, default ``0.5`` per
+  path)
+
+Scores are computed by the ``actstream_build_suggestions`` command and stored
+in ``FollowSuggestion``; ``actstream.actions.suggest_follows`` only reads them.
+"""
+from collections import defaultdict
+from heapq import nlargest
+
+from django.conf import settings
+
+FOF_WEIGHT = getattr(settings, 'ACTSTREAM_SUGGESTIONS_FOF_WEIGHT', 1.0)
+COFOLLOW_WEIGHT = getattr(settings, 'ACTSTREAM_SUGGESTIONS_COFOLLOW_WEIGHT',
+    0.5)
+
+
+def score_user(graph, user_id, limit=20, max_neighbors=100):
+    """
+    Returns up to ``limit`` ``(score, content_type_id, object_id)`` suggestions
+    for ``user_id``, best first. At most ``max_neighbors`` followed users and
+    co-followers per followed object are expanded.
+    """
+    user_ct = graph.user_content_type_id
+    content_type_ids = graph.content_type_ids()
+    following = dict((content_type_id, set(graph.following(user_id,
+        content_type_id))) for content_type_id in content_type_ids)
+    scores = defaultdict(float)
+
+    def add(weight, other_id):
+        for content_type_id in content_type_ids:
+            for object_id in graph.following(other_id, content_type_id):
+                scores[(content_type_id, object_id)] += weight
+
+    for friend_id in graph.following(user_id, user_ct)[:max_neighbors]:
+        add(FOF_WEIGHT, friend_id)
+    for content_type_id in content_type_ids:
+        for object_id in graph.following(user_id, content_type_id):
+            for other_id in graph.followers(content_type_id, object_id)[
+                    :max_neighbors]:
+                if other_id != user_id:
+                    add(COFOLLOW_WEIGHT, other_id)
+
+    candidates = ((score, content_type_id, object_id) for
+        (content_type_id, object_id), score in scores.iteritems()
+        if not object_id in following[content_type_id] and
+        not (content_type_id == user_ct and object_id == user_id))
+    return nlargest(limit, candidates)
+
+
+def affected_users(graph, since_id):
+    """
+    Ids of the users whose suggestions change because of the follows created
+    after the ``Follow`` with pk ``since_id``: the users who created them,
+    the users following those users (friends of friends) and the other
+    followers of the newly followed objects (co-follows).
+
+    This is a partial refresh. Deleted follows leave no trace and the other
+    co-followers of the objects those users already followed are not
+    included; rebuild every user from time to time to catch up.
+    """
+    from actstream.gfk import int_object_id
+    from actstream.models import Follow
+
+    users = set()
+    for user_id, content_type_id, object_id in Follow.objects.filter(
+            pk__gt=since_id).values_list('user_id', 'content_type_id',
+            'object_id').iterator():
+        users.add(user_id)
+        object_id = int_object_id(object_id)
+        if object_id is not None:
+            users.update(graph.followers(content_type_id, object_id))
+    for user_id in list(users):
+        users.update(graph.followers(graph.user_content_type_id, user_id))
+    return sorted(users)
+
+
+def store(results):
+    """
+    Replaces the stored suggestions of every user in ``results``, a list of
+    ``(user_id, suggestions)`` pairs as returned by ``score_user``.
+    """
+    from actstream.actions import _bulk_create
+    from actstream.models import FollowSuggestion
+
+    FollowSuggestion.objects.filter(user__in=[user_id for user_id, _ in
+        results]).delete()
+    _bulk_create(FollowSuggestion, [FollowSuggestion(user_id=user_id,
+        content_type_id=content_type_id, object_id=object_id, score=score)
+        for user_id, suggestions in results
+        for score, content_type_id, object_id in suggestions])
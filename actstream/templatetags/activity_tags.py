@@ -1,17 +1,44 @@
 from django.template import Variable, Library, Node, TemplateSyntaxError,\
     VariableDoesNotExist
-from django.template.loader import render_to_string
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import select_template
+from django.utils.timesince import timesince
+from django.utils.encoding import smart_unicode
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.core.urlresolvers import reverse
 
-from actstream.models import Follow
+from actstream import cache as actstream_cache
+from actstream.actions import FOLLOWING_KEYS_ATTR
+from actstream.models import Follow, FollowCounter
+from actstream.urlcache import memoize_urls, reverse, object_url as _object_url
 
 register = Library()
 
+# Compiled action templates by template name, see action_template
+_action_templates = {}
+
+# Stands for the time since the action in cached renderings, see render_action
+TIMESINCE_MARKER = u'<!--actstream:timesince-->'
+
+
+def _is_following(user, actor):
+    """
+    Answers follow checks from the set of objects ``user`` follows, loaded
+    once and memoized on the user instance for the rest of the request.
+    """
+    if not user or user.is_anonymous():
+        return False
+    keys = getattr(user, FOLLOWING_KEYS_ATTR, None)
+    if keys is None:
+        keys = Follow.objects.following_keys(user)
+        setattr(user, FOLLOWING_KEYS_ATTR, keys)
+    return (ContentType.objects.get_for_model(actor).pk,
+        smart_unicode(actor.pk)) in keys
+
 
 def _is_following_helper(context, actor):
-    return Follow.objects.is_following(context.get('user'), actor)
+    return _is_following(context.get('user'), actor)
 
 class DisplayActivityFollowLabel(Node):
     def __init__(self, actor, follow, unfollow):
@@ -40,8 +67,8 @@ class DisplayActivityFollowUrl(Node):
         actor_instance = self.actor.resolve(context)
         content_type = ContentType.objects.get_for_model(actor_instance).pk
         if _is_following_helper(context, actor_instance):
-            return reverse('actstream_unfollow', kwargs={'content_type_id': content_type, 'object_id': actor_instance.pk})
-        return reverse('actstream_follow', kwargs={'content_type_id': content_type, 'object_id': actor_instance.pk})
+            return reverse('actstream_unfollow', (content_type, actor_instance.pk))
+        return reverse('actstream_follow', (content_type, actor_instance.pk))
 
 def do_activity_follow_url(parser, tokens):
     bits = tokens.contents.split()
@@ -53,13 +80,17 @@ def do_activity_follow_url(parser, tokens):
 @register.simple_tag
 def activity_followers_url(instance):
     content_type = ContentType.objects.get_for_model(instance).pk
-    return reverse('actstream_followers',
-        kwargs={'content_type_id': content_type, 'object_id': instance.pk})
+    return reverse('actstream_followers', (content_type, instance.pk))
 
 
 @register.simple_tag
 def activity_followers_count(instance):
-    return Follow.objects.for_object(instance).count()
+    return FollowCounter.objects.followers(instance)
+
+
+@register.simple_tag
+def activity_following_count(user):
+    return FollowCounter.objects.following(user)
 
 
 class AsNode(Node):
@@ -125,44 +156,174 @@ class DisplayActionLabel(AsNode):
         return result
 
 
+def action_template(verb):
+    """
+    Compiled template for actions with ``verb``: ``activity/<verb>/action.html``
+    when it exists, ``activity/action.html`` otherwise. Each verb is looked up
+    once per process, misses included, unless ``TEMPLATE_DEBUG`` is on.
+    """
+    name = 'activity/%s/action.html' % verb.replace(' ', '_')
+    template = _action_templates.get(name)
+    if template is None:
+        template = select_template([name, 'activity/action.html'])
+        if not settings.TEMPLATE_DEBUG:
+            _action_templates[name] = template
+    return template
+
+
+class ActionCacheShared(Node):
+    """
+    Marks an action template as independent of the current user, see
+    ``fragment_variant``.
+    """
+
+    def render(self, context):
+        return ''
+
+
+def fragment_variant(template, context, variant=''):
+    """
+    Tells apart the cached renderings of ``template`` for different users,
+    unless the template holds the ``action_cache_shared`` tag. The user is
+    ``user`` of the context or ``request.user``.
+    """
+    shared = getattr(template, '_actstream_shared', None)
+    if shared is None:
+        shared = bool(template.nodelist.get_nodes_by_type(ActionCacheShared))
+        template._actstream_shared = shared
+    if shared:
+        return variant
+    user = context.get('user') or getattr(context.get('request'), 'user',
+        None)
+    if user is None or user.is_anonymous():
+        return '%s:anonymous' % variant
+    return '%s:user:%s' % (variant, user.pk)
+
+
+def _render(template, values, context):
+    context.update(values)
+    try:
+        return template.render(context)
+    finally:
+        context.pop()
+
+
+def render_action_template(verb, values, context):
+    """
+    Same as ``render_to_string`` with the template list of ``verb``.
+    """
+    return _render(action_template(verb), values, context)
+
+
+def render_action(action_instance, values, context, variant=''):
+    """
+    Renders ``action_instance`` with the template of its verb. With
+    ``ACTSTREAM_ACTION_CACHE`` on, the rendering is cached until the action
+    or one of its objects is saved, with a marker in place of the time since
+    the action, filled in on every render. ``variant`` tells renderings with
+    different ``values`` apart. Renderings are cached per user unless the
+    template is shared, see ``fragment_variant``.
+    """
+    template = action_template(action_instance.verb)
+    if not actstream_cache.ACTION_CACHE:
+        return _render(template, values, context)
+    key = actstream_cache.action_fragment_key(action_instance, template.name,
+        fragment_variant(template, context, variant))
+    content = cache.get(key)
+    if content is None:
+        values = dict(values, actstream_fragment=True)
+        content = _render(template, values, context)
+        cache.set(key, content, actstream_cache.ACTION_CACHE_TIMEOUT)
+    return content.replace(TIMESINCE_MARKER,
+        timesince(action_instance.timestamp))
+
+
 class DisplayAction(AsNode):
 
+    @memoize_urls
     def render_result(self, context):
         action_instance = self.args[0].resolve(context)
-        templates = [
-            'activity/%s/action.html' % action_instance.verb.replace(' ', '_'),
-            'activity/action.html',
-        ]
-        return render_to_string(templates, {'action': action_instance},
+        return render_action(action_instance, {'action': action_instance},
             context)
 
 
-class DisplayActionShort(Node):
-    def __init__(self, action, varname=None):
-        self.action = Variable(action)
-        self.varname = varname
+class DisplayActionShort(AsNode):
 
-    def render(self, context):
+    @memoize_urls
+    def render_result(self, context):
         action_instance = self.args[0].resolve(context)
-        templates = [
-            'activity/%s/action.html' % action_instance.verb.replace(' ', '_'),
-            'activity/action.html',
-        ]
-        return render_to_string(templates, {'action': action_instance,
-            'hide_actor': True}, context)
+        return render_action(action_instance, {'action': action_instance,
+            'hide_actor': True}, context, 'short')
+
+
+def render_actions(actions, context):
+    """
+    Renders every action of ``actions`` with the template of its verb in a
+    context pushed once, reading and storing the renderings of the action
+    cache (see ``render_action``) with one cache query each.
+    """
+    templates = [action_template(action.verb) for action in actions]
+    keys = None
+    if actstream_cache.ACTION_CACHE:
+        keys = actstream_cache.action_fragment_keys(actions,
+            [template.name for template in templates],
+            [fragment_variant(template, context) for template in templates])
+        cached = cache.get_many(keys)
+    output, rendered = [], {}
+    context.update({'action': None, 'actstream_fragment': keys is not None})
+    try:
+        for i, action_instance in enumerate(actions):
+            if keys is not None and keys[i] in cached:
+                content = cached[keys[i]]
+            else:
+                context['action'] = action_instance
+                content = templates[i].render(context)
+                if keys is None:
+                    output.append(content)
+                    continue
+                rendered[keys[i]] = content
+            output.append(content.replace(TIMESINCE_MARKER,
+                timesince(action_instance.timestamp)))
+    finally:
+        context.pop()
+    if rendered:
+        cache.set_many(rendered, actstream_cache.ACTION_CACHE_TIMEOUT)
+    return output
+
+
+class DisplayActionList(AsNode):
+    """
+    Renders a whole list of actions. Querysets that were not evaluated yet
+    get their generic relations fetched in bulk first.
+    """
+
+    @memoize_urls
+    def render_result(self, context):
+        actions_instance = self.args[0].resolve(context)
+        if hasattr(actions_instance, 'fetch_generic_relations') and \
+                actions_instance._result_cache is None:
+            actions_instance = actions_instance.fetch_generic_relations()
+        return u''.join(render_actions(list(actions_instance), context))
+
+
+class ActionTimesince(AsNode):
+    """
+    Time since the action, left as a marker in cached renderings.
+    """
+
+    def render_result(self, context):
+        if context.get('actstream_fragment'):
+            return TIMESINCE_MARKER
+        return timesince(self.args[0].resolve(context).timestamp)
 
 
 class DisplayGroupedActions(AsNode):
 
-    def render(self, context):
+    @memoize_urls
+    def render_result(self, context):
         actions_instance = self.args[0].resolve(context)
-        templates = [
-            'activity/%s/action.html' %
-                actions_instance.verb.replace(' ', '_'),
-            'activity/action.html',
-        ]
-        return render_to_string(templates, {'actions': actions_instance},
-            context)
+        return render_action_template(actions_instance.verb,
+            {'actions': actions_instance}, context)
 
 
 class UserContentTypeNode(Node):
@@ -179,6 +340,10 @@ def display_action(parser, token):
     return DisplayAction.handle_token(parser, token)
 
 
+def display_action_list(parser, token):
+    return DisplayActionList.handle_token(parser, token)
+
+
 def display_action_short(parser, token):
     return DisplayActionShort.handle_token(parser, token)
 
@@ -187,22 +352,42 @@ def display_grouped_actions(parser, token):
     return DisplayGroupedActions.handle_token(parser, token)
 
 
+def action_timesince(parser, token):
+    return ActionTimesince.handle_token(parser, token)
+
+
 def action_label(parser, token):
     return DisplayActionLabel.handle_token(parser, token)
 
 
+def action_cache_shared(parser, token):
+    if len(token.split_contents()) != 1:
+        raise TemplateSyntaxError, "Accepted format {% action_cache_shared %}"
+    return ActionCacheShared()
+
+
 # TODO: remove this, it's heinous
 def get_user_contenttype(parser, token):
     return UserContentTypeNode(*token.split_contents())
 
 def is_following(user, actor):
-    return Follow.objects.is_following(user, actor)
+    return _is_following(user, actor)
+
+def object_url(obj):
+    """
+    URL of any object, see ``actstream.urlcache.object_url``.
+    """
+    return _object_url(obj)
 
 register.filter(is_following)
+register.filter(object_url)
 register.tag(display_action)
+register.tag(display_action_list)
 register.tag(display_action_short)
 register.tag(display_grouped_actions)
+register.tag(action_timesince)
 register.tag(action_label)
+register.tag(action_cache_shared)
 register.tag(get_user_contenttype)
 register.tag('activity_follow_url', do_activity_follow_url)
 register.tag('activity_follow_label', do_activity_follow_label)
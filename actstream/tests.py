@@ -1,20 +1,36 @@
+import httplib
+import os
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from random import choice
+from threading import Thread
 
 from django.db import connection
+from django.core.cache import cache
+from django.core.management import call_command
 from django.db.models import get_model
+from django.db.models.signals import post_save, post_delete
+from django.http import Http404
 from django.test import TestCase
+from django.test.client import RequestFactory
 from django.conf import settings
+from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, AnonymousUser, Group
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.template.loader import Template, Context
+from django.utils import simplejson, translation
 
-from actstream.models import Action, Follow, model_stream, user_stream,\
-    setup_generic_relations
-from actstream.actions import follow, unfollow
+from actstream.models import Action, Follow, FollowCounter, model_stream,\
+    user_stream, setup_generic_relations, WebhookSubscription, \
+    WebhookDelivery
+from actstream.actions import follow, unfollow, follow_many, unfollow_many,\
+    prune_actions, prune_deleted_object, suggest_follows
 from actstream.exceptions import ModelNotActionable
-from actstream.signals import action
-from actstream import settings as actstream_settings
+from actstream.signals import action, actions_bulk_created, \
+    generic_relations_fetched
+from actstream import settings as actstream_settings, registry, gfk, bloom,\
+    cache as actstream_cache, feeds, live, suggestions, urlcache, webhooks
+from actstream.graph import FollowGraph, follow_rows, get_follow_graph
 
 
 class ActivityBaseTestCase(TestCase):
@@ -31,6 +47,24 @@ class ActivityBaseTestCase(TestCase):
     def tearDown(self):
         actstream_settings.MODELS = self.old_MODELS
 
+    def override(self, module, **values):
+        """
+        Sets the attributes ``values`` of ``module`` until the end of the
+        test.
+        """
+        for name, value in values.items():
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, value)
+
+    def connect(self, signal, receiver, sender=None):
+        """
+        Connects ``receiver`` to ``signal`` until the end of the test.
+        """
+        dispatch_uid = 'actstream.tests.%s' % self._testMethodName
+        signal.connect(receiver, sender=sender, dispatch_uid=dispatch_uid)
+        self.addCleanup(signal.disconnect, sender=sender,
+            dispatch_uid=dispatch_uid)
+
 
 class ActivityTestCase(ActivityBaseTestCase):
     urls = 'actstream.urls'
@@ -118,6 +152,294 @@ class ActivityTestCase(ActivityBaseTestCase):
                                      settings.LANGUAGE_CODE))
         self.assert_(atom.find('Activity feed for your followed actors') > -1)
 
+    def test_feed_conditional_get(self):
+        url = '/feed/%s/' % ContentType.objects.get_for_model(Group).pk
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assert_(response.has_header('Last-Modified'))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        action.send(self.group, verb='was renamed')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # The newest action of a user stream can stay the same when the
+        # follows change, the follow version changes the ETag
+        feed = feeds.UserActivityFeed()
+        etag = feed.validators(self.user1)[0]
+        unfollow(self.user1, self.user2)
+        self.assertNotEqual(feed.validators(self.user1)[0], etag)
+
+    def test_feed_cache(self):
+        self.override(actstream_cache, FEED_CACHE=True)
+        self.connect(post_save, actstream_cache.action_versions_handler,
+            Action)
+        url = '/feed/%s/' % ContentType.objects.get_for_model(Group).pk
+        content = self.client.get(url).content
+        # The model version is unchanged, the body of the first request is
+        # served without the new verb
+        Action.objects.filter(verb='responded to').update(verb='replied to')
+        self.assertEqual(self.client.get(url).content, content)
+
+        # A saved action bumps the version and the feed is rendered again
+        action.send(self.group, verb='was renamed')
+        content = self.client.get(url).content
+        self.assert_('was renamed' in content)
+        self.assert_('replied to' in content)
+
+    def test_feed_item_limit(self):
+        feed = feeds.ModelActivityFeed()
+        feed.item_limit = 2
+        actions = list(model_stream(User))
+        self.assertEqual(len(actions), 5)
+        for page in (1, 2, 3):
+            feed.page = page
+            self.assertEqual(list(feed.items(User)),
+                actions[(page - 1) * 2:page * 2])
+
+        url = '/feed/%s/' % ContentType.objects.get_for_model(User).pk
+        self.assertEqual(self.client.get(url).content.count('<item>'), 5)
+        self.assertEqual(self.client.get(url, {'page': 2}).content.count(
+            '<item>'), 0)
+
+    def test_streaming_feed(self):
+        feed = feeds.AtomModelActivityFeed()
+        feed.streaming, feed.chunk_size = True, 2
+        response = feed(RequestFactory().get('/'),
+            ContentType.objects.get_for_model(User).pk)
+        # Root elements, three chunks of entries and the closing tag
+        chunks = list(response)
+        self.assertEqual(len(chunks), 5)
+        content = ''.join(chunks)
+        self.assertEqual(content.count('<entry>'), 5)
+        self.assert_(content.endswith('</feed>'))
+
+    def test_json_activity_stream(self):
+        url = '/actors/%s/%s/json/' % (
+            ContentType.objects.get_for_model(User).pk, self.user1.pk)
+        page = simplejson.loads(self.client.get(url, {'limit': 2}).content)
+        self.assertEqual([item['verb'] for item in page['items']],
+            [u'commented on', u'started following'])
+        self.assertEqual(page['items'][0]['actor']['displayName'], u'admin')
+        self.assertEqual(page['items'][0]['actor']['objectType'], u'person')
+        self.assertEqual(page['items'][1]['target']['displayName'], u'Two')
+
+        page = simplejson.loads(self.client.get(url, {'limit': 2,
+            'before': page['next'], 'fields': 'verb'}).content)
+        self.assertEqual(page, {'items': [{'verb': u'joined'}],
+            'next': None})
+        self.assertEqual(self.client.get(url, {'fields': 'bogus'})
+            .status_code, 400)
+
+    def test_url_resolution(self):
+        ctype_id = ContentType.objects.get_for_model(Group).pk
+        self.assertEqual(urlcache.reverse('actstream_actor',
+            (ctype_id, self.group.pk)), reverse('actstream_actor', None,
+            (ctype_id, self.group.pk)))
+        translation.activate('de')
+        try:
+            urlcache.reverse('actstream_actor', (ctype_id, self.group.pk))
+        finally:
+            translation.deactivate()
+        self.assertEqual(len([key for key in urlcache._templates
+            if key[2] == 'de']), 1)
+        created_action = Action.objects.get(verb='responded to')
+        self.assertEqual(created_action.actor_url(),
+            '/actors/%s/%s/' % (ctype_id, self.group.pk))
+
+        calls = []
+        self.user1.get_absolute_url = lambda: calls.append(1) or '/admin/'
+        urls = urlcache.memoize_urls(lambda: [urlcache.object_url(self.user1)
+            for i in range(3)])()
+        self.assertEqual((urls, len(calls)), (['/admin/'] * 3, 1))
+
+    def test_feed_snapshots(self):
+        self.override(actstream_cache, FEED_SNAPSHOTS=True)
+        self.connect(post_save, actstream_cache.action_versions_handler,
+            Action)
+        self.addCleanup(cache.clear)
+        call_command('actstream_build_feeds', workers=1, verbosity=0)
+        Action.objects.filter(verb='joined').update(verb='left')
+        url = '/feed/%s/' % ContentType.objects.get_for_model(User).pk
+        host = Site.objects.get_current().domain
+        # Requests without query string get the snapshot built before the
+        # update, paged requests render the feed
+        self.assert_('joined' in self.client.get(url,
+            HTTP_HOST=host).content)
+        self.assert_('left' in self.client.get(url, {'page': 1},
+            HTTP_HOST=host).content)
+        # Snapshots are built for the Site domain and scheme only
+        self.assert_('left' in self.client.get(url).content)
+        self.assert_('left' in self.client.get(url, HTTP_HOST=host,
+            **{'wsgi.url_scheme': 'https'}).content)
+
+        # A saved action makes the snapshot stale
+        action.send(self.user1, verb='was renamed')
+        content = self.client.get(url, HTTP_HOST=host).content
+        self.assert_('was renamed' in content and 'left' in content)
+
+    def test_multi_object_feed(self):
+        other = Group.objects.create(name='OtherGroup')
+        action.send(self.user1, verb='painted', action_object=self.group)
+        action.send(self.user1, verb='sculpted', action_object=self.user2)
+        action.send(self.user1, verb='knitted', action_object=other)
+        objects = '%s:%s,%s:%s' % (
+            ContentType.objects.get_for_model(Group).pk, self.group.pk,
+            ContentType.objects.get_for_model(User).pk, self.user2.pk)
+        content = self.client.get('/feed/objects/',
+            {'objects': objects}).content
+        self.assert_('painted' in content and 'sculpted' in content)
+        self.assert_(not 'knitted' in content)
+        request = RequestFactory().get('/feed/objects/atom/',
+            {'objects': 'user2'})
+        self.assertRaises(Http404, feeds.MultiObjectActivityFeed().get_object,
+            request)
+
+    def test_live_stream(self):
+        old_LIVE = live.LIVE
+        old_LIVE_PENDING_TIMEOUT = live.LIVE_PENDING_TIMEOUT
+        live.LIVE = True
+        post_save.connect(live.action_published_handler, sender=Action,
+            dispatch_uid='actstream.tests.live')
+        try:
+            after = live.hub.sequence
+            action.send(self.user1, verb='went live')
+            url = '/actors/%s/%s/live/' % (
+                ContentType.objects.get_for_model(User).pk, self.user1.pk)
+            response = self.client.get(url, {'poll': 1,
+                'after': live.hub.cursor(after)})
+            data = simplejson.loads(response.content)
+            self.assertEqual([item['verb'] for item in data['items']],
+                ['went live'])
+            self.assertEqual(data['next'], live.hub.cursor(live.hub.sequence))
+            # Cursors of another process or ahead of the hub resume from now
+            self.assertEqual(live.hub.parse_cursor('0-%d' % after),
+                live.hub.sequence)
+            self.assertEqual(live.hub.parse_cursor(live.hub.cursor(
+                live.hub.sequence + 5)), live.hub.sequence)
+            self.assertEqual(live.hub.parse_cursor(live.hub.cursor(after)),
+                after)
+            self.assertEqual(live.hub.wait(after, live.object_matcher('actor',
+                ContentType.objects.get_for_model(Group).pk, self.group.pk),
+                0), ([], live.hub.sequence))
+
+            # Bulk created actions without primary key are not published
+            sequence = live.hub.sequence
+            live.action_published_handler(Action, actions=[Action(
+                actor=self.user1, verb='went bulk')])
+            self.assertEqual(live.hub.sequence, sequence)
+
+            # Actions not readable yet are retried, not skipped
+            after = live.hub.sequence
+            live.hub.publish(Action(pk=Action.objects.order_by('-pk')[0].pk
+                + 1, actor=self.user1, verb='not committed'))
+            matches = live.object_matcher('actor',
+                ContentType.objects.get_for_model(User).pk, self.user1.pk)
+            self.assertEqual(live.hub.read(after, matches, 0), ([], after))
+            # Other clients share the attempt instead of querying again
+            self.assertNumQueries(0, lambda: self.assertEqual(
+                live.hub.read(after, matches, 0), ([], after)))
+            live.LIVE_PENDING_TIMEOUT = 0
+            self.assertEqual(live.hub.read(after, matches, 0),
+                ([], after + 1))
+        finally:
+            live.LIVE = old_LIVE
+            live.LIVE_PENDING_TIMEOUT = old_LIVE_PENDING_TIMEOUT
+            post_save.disconnect(sender=Action,
+                dispatch_uid='actstream.tests.live')
+
+    def test_webhooks(self):
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                received.append((self.path,
+                    self.headers.get(webhooks.SIGNATURE_HEADER), body))
+                self.send_response(self.path == '/fail/' and 500 or 200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%d' % server.server_port
+        WebhookSubscription.objects.create(url=url + '/ok/', secret='s3cret')
+        failing = WebhookSubscription.objects.create(url=url + '/fail/')
+        WebhookSubscription.objects.create(url=url + '/other/', verbs='left')
+        post_save.connect(webhooks.enqueue_handler, sender=Action,
+            dispatch_uid='actstream.tests.webhooks')
+        try:
+            action.send(self.user1, verb='hooked')
+            action.send(self.user1, verb='hooked again')
+            call_command('actstream_send_webhooks', verbosity=0)
+
+            # A kept open connection closed by the server is replaced
+            pool = webhooks.ConnectionPool()
+            pool.connections[('http', '127.0.0.1:%d' % server.server_port)] \
+                = httplib.HTTPConnection('127.0.0.1', 1)
+            try:
+                self.assertEqual(pool.post(url + '/retry/', '{}', {}), 200)
+            finally:
+                pool.close()
+        finally:
+            post_save.disconnect(sender=Action,
+                dispatch_uid='actstream.tests.webhooks')
+            server.shutdown()
+            server.server_close()
+
+        received.sort()
+        self.assertEqual([path for path, signature, body in received],
+            ['/fail/', '/ok/', '/retry/'])
+        path, signature, body = received[1]
+        self.assertEqual(signature, webhooks.sign('s3cret', body))
+        self.assertEqual([item['verb'] for item in
+            simplejson.loads(body)['items']], ['hooked again', 'hooked'])
+        self.assertEqual(list(WebhookDelivery.objects.values_list(
+            'subscription', 'attempts', 'last_error')),
+            [(failing.pk, 1, 'HTTP 500')] * 2)
+
+    def test_webhook_claim(self):
+        subscription = WebhookSubscription.objects.create(
+            url='http://127.0.0.1/')
+        delivery = WebhookDelivery.objects.create(subscription=subscription,
+            action=Action.objects.all()[0])
+        self.assertEqual([row[0] for row in webhooks.claim()], [delivery.pk])
+        # Claimed rows are not due for other runners
+        self.assertEqual(webhooks.claim(), [])
+
+    def test_webhooks_follow_many(self):
+        subscription = WebhookSubscription.objects.create(
+            url='http://127.0.0.1/', verbs='started following')
+        last_pk = Action.objects.order_by('-pk')[0].pk
+        actions_bulk_created.connect(webhooks.enqueue_handler, sender=Action,
+            dispatch_uid='actstream.tests.webhooks_follow_many')
+        try:
+            other = Group.objects.create(name='OtherGroup')
+            follow_many(self.user1, [self.group, other])
+            # the actions of the first call are not enqueued again
+            follow_many(self.user1, [self.comment])
+        finally:
+            actions_bulk_created.disconnect(sender=Action,
+                dispatch_uid='actstream.tests.webhooks_follow_many')
+        created = Action.objects.filter(pk__gt=last_pk,
+            verb='started following').values_list('pk', flat=True)
+        self.assertEqual(len(created), 3)
+        self.assertEqual(sorted(WebhookDelivery.objects.filter(
+            subscription=subscription).values_list('action', flat=True)),
+            sorted(created))
+
     def test_action_object(self):
         action.send(self.user1, verb='created comment',
             action_object=self.comment, target=self.group)
@@ -152,6 +474,21 @@ class ActivityTestCase(ActivityBaseTestCase):
         self.assertEquals(f1, f2, "Should have received the same Follow "
             "object that I first submitted")
 
+    def test_follow_verbs_and_roles(self):
+        follow(self.user2, self.group, verbs=['responded to'])
+        self.assertEqual(map(unicode, Action.objects.user(self.user2)),
+            [u'CoolGroup responded to admin: Sweet Group!... 0 minutes ago'])
+
+        follow(self.user2, self.group, verbs=['joined'], roles=['target'])
+        self.assertEqual(Follow.objects.get(user=self.user2).get_roles(),
+            ['target'])
+        self.assertEqual(map(unicode, Action.objects.user(self.user2)), [
+            u'Two joined CoolGroup 0 minutes ago',
+            u'admin joined CoolGroup 0 minutes ago',
+        ])
+        self.assertRaises(ValueError, follow, self.user2, self.group,
+            roles=['owner'])
+
     def test_zzzz_no_orphaned_actions(self):
         actions = self.user1.actor_actions.count()
         self.user2.delete()
@@ -200,6 +537,99 @@ class ActivityTestCase(ActivityBaseTestCase):
             'other_user': self.user2}))
         self.assertEqual(output, 'yup')
 
+    def test_tag_follow_label_queries(self):
+        src = '{% load activity_tags %}{% for u in users %}'\
+            '{% activity_follow_label u yup nope %}'\
+            '{% if user|is_following:u %}!{% endif %}{% endfor %}'
+        context = Context({'user': self.user1,
+            'users': [self.user1, self.user2, self.user2]})
+        self.assertNumQueries(1, lambda: Template(src).render(context))
+        self.assertEqual(Template(src).render(context), u'nopeyup!yup!')
+
+        unfollow(self.user1, self.user2)
+        self.assertEqual(Template(src).render(context), u'nopenopenope')
+
+    def test_tag_display_action_templates(self):
+        from actstream.templatetags import activity_tags
+
+        calls = []
+        old_select_template = activity_tags.select_template
+        old_TEMPLATE_DEBUG = settings.TEMPLATE_DEBUG
+        activity_tags.select_template = lambda names: \
+            calls.append(names) or old_select_template(names)
+        settings.TEMPLATE_DEBUG = False
+        activity_tags._action_templates.clear()
+        try:
+            src = '{% load activity_tags %}{% for a in actions %}'\
+                '{% display_action a %}{% display_action_short a %}'\
+                '{% endfor %}'
+            output = Template(src).render(Context({
+                'actions': Action.objects.filter(verb='joined')}))
+        finally:
+            activity_tags.select_template = old_select_template
+            settings.TEMPLATE_DEBUG = old_TEMPLATE_DEBUG
+            activity_tags._action_templates.clear()
+        self.assertEqual(output.count('joined'), 2 *
+            Action.objects.filter(verb='joined').count())
+        self.assertEqual(calls, [['activity/joined/action.html',
+            'activity/action.html']])
+
+    def test_tag_display_action_cache(self):
+        from actstream.templatetags import activity_tags
+        self.override(actstream_cache, ACTION_CACHE=True)
+        self.connect(post_save, actstream_cache.object_versions_handler)
+        self.addCleanup(cache.clear)
+        self.addCleanup(activity_tags._action_templates.clear)
+        src = '{% load activity_tags %}{% display_action action %}'
+        action_id = Action.objects.get(verb='joined',
+            actor_object_id=self.user1.pk).pk
+        render = lambda: Template(src).render(Context({
+            'action': Action.objects.get(pk=action_id)}))
+        output = render()
+        self.assert_('joined' in output and 'minutes ago' in output)
+        self.assert_(not 'actstream:timesince' in output)
+
+        # The versions of the action and its objects are unchanged, the
+        # rendering with the old verb is reused
+        Action.objects.filter(pk=action_id).update(verb='met')
+        self.assertEqual(render(), output)
+
+        # Saving the actor invalidates it
+        self.user1.save()
+        self.assert_('met' in render())
+
+        # Renderings are per user unless the template is shared
+        action.send(self.user1, verb='greeted')
+        greeted = Action.objects.get(verb='greeted')
+        name = 'activity/greeted/action.html'
+        activity_tags._action_templates[name] = Template(
+            '{{ user }} {{ action.verb }}')
+        render = lambda user: Template(src).render(Context({
+            'action': greeted, 'user': user}))
+        self.assertEqual(render(self.user1), u'admin greeted')
+        self.assertEqual(render(self.user2), u'Two greeted')
+        activity_tags._action_templates[name] = Template(
+            '{% load activity_tags %}{% action_cache_shared %}{{ user }}')
+        self.assertEqual(render(self.user1), u'admin')
+        self.assertEqual(render(self.user2), u'admin')
+
+    def test_tag_display_action_list(self):
+        actions = Action.objects.filter(verb='joined').order_by('id')
+        fetches = []
+        receiver = lambda sender, stats, **kwargs: fetches.append(stats)
+        generic_relations_fetched.connect(receiver)
+        try:
+            output = Template('{% load activity_tags %}'
+                '{% display_action_list actions %}').render(Context({
+                'actions': actions}))
+        finally:
+            generic_relations_fetched.disconnect(receiver)
+        self.assertEqual([stats['rows'] for stats in fetches],
+            [actions.count()])
+        self.assertEqual(output, Template('{% load activity_tags %}'
+            '{% for a in actions %}{% display_action a %}{% endfor %}')
+            .render(Context({'actions': actions})))
+
     def test_model_actions_with_kwargs(self):
         """
         Testing the model_actions method of the ActionManager
@@ -218,6 +648,222 @@ class ActivityTestCase(ActivityBaseTestCase):
                 u'Two joined CoolGroup 0 minutes ago',
                 ])
 
+    def test_int_object_ids(self):
+        created_action = Action.objects.get(verb='responded to')
+        self.assertEqual(created_action.actor_object_id_int, self.group.pk)
+        self.assertEqual(created_action.target_object_id_int, self.comment.pk)
+        self.assertEqual(created_action.action_object_object_id_int, None)
+        self.assertEqual(Follow.objects.get(user=self.user1).object_id_int,
+            self.user2.pk)
+
+        old_INT_OBJECT_IDS = gfk.INT_OBJECT_IDS
+        gfk.INT_OBJECT_IDS = True
+        try:
+            self.assertEqual(map(unicode, Action.objects.actor(self.group)),
+                [u'CoolGroup responded to admin: Sweet Group!... 0 minutes ago'])
+            self.assertEqual(map(unicode, Action.objects.user(self.user1)), [
+                u'Two started following CoolGroup 0 minutes ago',
+                u'Two joined CoolGroup 0 minutes ago',
+            ])
+        finally:
+            gfk.INT_OBJECT_IDS = old_INT_OBJECT_IDS
+
+    def test_sync_object_ids(self):
+        Action.objects.update(actor_object_id_int=None)
+        Action.objects.filter(verb='joined').update(actor_object_id='x1')
+        call_command('actstream_sync_object_ids', verbosity=0)
+        self.assertFalse(Action.objects.exclude(verb='joined').filter(
+            actor_object_id_int=None).exists())
+        self.assertEqual(set(Action.objects.filter(verb='joined')
+            .values_list('actor_object_id_int', flat=True)), set([None]))
+        self.assertEqual(Action.objects.get(verb='responded to')
+            .actor_object_id_int, self.group.pk)
+
+    def test_prune_orphans(self):
+        count = Action.objects.count()
+        Action.objects.create(verb='haunted', actor_object_id='999999',
+            actor_content_type=ContentType.objects.get_for_model(User))
+        call_command('actstream_prune_orphans', verbosity=0)
+        self.assertFalse(Action.objects.filter(verb='haunted').exists())
+        self.assertEqual(Action.objects.count(), count)
+
+    def test_prune_actions_tombstone(self):
+        group_ct = ContentType.objects.get_for_model(Group)
+        self.assertEqual(prune_actions(group_ct.pk, [self.group.pk],
+            tombstone=True), 5)
+        self.assertEqual(Action.objects.public(target_object_id=self.group.pk,
+            target_content_type=group_ct).count(), 0)
+        self.assertEqual(Action.objects.filter(actor_object_id=self.group.pk,
+            actor_content_type=group_ct).count(), 1)
+
+    def test_prune_on_delete_tombstone(self):
+        group_ct = ContentType.objects.get_for_model(Group)
+        referencing = Action.objects.referencing(group_ct.pk, [self.group.pk])
+        count = referencing.count()
+        old_PRUNE_ON_DELETE = actstream_settings.PRUNE_ON_DELETE
+        actstream_settings.PRUNE_ON_DELETE = 'tombstone'
+        post_delete.connect(prune_deleted_object,
+            dispatch_uid='actstream.tests.prune')
+        try:
+            self.group.delete()
+        finally:
+            actstream_settings.PRUNE_ON_DELETE = old_PRUNE_ON_DELETE
+            post_delete.disconnect(dispatch_uid='actstream.tests.prune')
+        self.assert_(count > 0)
+        self.assertEqual(referencing.count(), count)
+        self.assertFalse(referencing.filter(public=True).exists())
+
+    def test_follow_counters(self):
+        self.assertEqual(FollowCounter.objects.followers(self.group), 1)
+        self.assertEqual(FollowCounter.objects.following(self.user1), 1)
+        follow(self.user1, self.group)
+        self.assertEqual(FollowCounter.objects.followers(self.group), 2)
+        self.assertEqual(FollowCounter.objects.following(self.user1), 2)
+        unfollow(self.user2, self.group)
+        self.assertEqual(FollowCounter.objects.followers(self.group), 1)
+        self.assertEqual(FollowCounter.objects.following(self.user2), 0)
+
+        FollowCounter.objects.filter(object_id=self.group.pk).update(
+            followers=42)
+        call_command('actstream_rebuild_follow_counters', verbosity=0)
+        self.assertEqual(FollowCounter.objects.followers(self.group), 1)
+
+        src = '{% load activity_tags %}{% activity_followers_count group %}'
+        self.assertEqual(Template(src).render(Context({'group': self.group})),
+            u'1')
+
+    def test_follow_many(self):
+        follows = follow_many(self.user1, [self.user2, self.group,
+            self.comment])
+        self.assertEqual(len(follows), 2)
+        self.assertEqual(Follow.objects.filter(user=self.user1).count(), 3)
+        self.assertEqual(FollowCounter.objects.followers(self.group), 2)
+        self.assertEqual(FollowCounter.objects.following(self.user1), 3)
+        self.assertEqual(self.user1.actor_actions.filter(
+            verb='started following').count(), 3)
+        self.assertEqual(follow_many(self.user1, [self.group, self.comment],
+            verbs=['commented']), [])
+        self.assertEqual(Follow.objects.get(user=self.user1,
+            content_type=ContentType.objects.get_for_model(self.group),
+            object_id=self.group.pk).get_verbs(), ['commented'])
+        self.assertEqual(self.user1.actor_actions.filter(
+            verb='started following').count(), 3)
+
+        self.assertEqual(unfollow_many(self.user1, [self.group,
+            self.comment]), 2)
+        self.assertEqual(Follow.objects.filter(user=self.user1).count(), 1)
+        self.assertEqual(FollowCounter.objects.followers(self.group), 1)
+        self.assertEqual(FollowCounter.objects.following(self.user1), 1)
+        self.assertEqual(unfollow_many(self.user1, [self.group]), 0)
+
+    def test_follow_graph(self):
+        follow(self.user2, self.user1)
+        user_ct = ContentType.objects.get_for_model(User)
+        group_ct = ContentType.objects.get_for_model(Group)
+        graph = FollowGraph.from_rows(follow_rows(chunk_size=1), user_ct.pk)
+        self.assertEqual(graph.followers(user_ct.pk, self.user2.pk),
+            (self.user1.pk,))
+        self.assertEqual(graph.following(self.user2.pk, group_ct.pk),
+            (self.group.pk,))
+        self.assertTrue(graph.is_mutual(self.user1.pk, self.user2.pk))
+        self.assertEqual(graph.mutual(self.user1.pk), (self.user2.pk,))
+        self.assertEqual(graph.common_following(self.user1.pk, self.user2.pk,
+            group_ct.pk), ())
+        self.assertFalse(graph.is_following(self.user1.pk, group_ct.pk,
+            self.group.pk))
+        self.assertTrue(graph.is_following(self.user2.pk, group_ct.pk,
+            self.group.pk))
+        self.assertEqual(get_follow_graph(), None)
+        self.assertEqual(get_follow_graph(os.path.join(
+            os.path.dirname(__file__), 'missing.graph')), None)
+
+    def test_followers_page(self):
+        follow(self.user1, self.group)
+        users, cursor = Follow.objects.followers_page(self.group, limit=1)
+        self.assertEqual(users, [self.user2])
+        users, cursor = Follow.objects.followers_page(self.group, cursor,
+            limit=1)
+        self.assertEqual((users, cursor), ([self.user1], None))
+
+        response = self.client.get('/followers/%s/%s/json/?after=%s' % (
+            ContentType.objects.get_for_model(Group).pk, self.group.pk,
+            Follow.objects.get(user=self.user2, object_id=self.group.pk).pk))
+        self.assertEqual(simplejson.loads(response.content), {
+            'followers': [{'id': self.user1.pk, 'username': u'admin',
+                'name': u''}],
+            'next': None,
+        })
+
+    def test_follow_counters_floor_and_prune(self):
+        FollowCounter.objects.followers(self.group)
+        FollowCounter.objects.filter(object_id=self.group.pk).update(
+            followers=0)
+        unfollow(self.user2, self.group)
+        self.assertEqual(FollowCounter.objects.followers(self.group), 0)
+
+        group_ct, group_pk = ContentType.objects.get_for_model(Group), \
+            self.group.pk
+        self.group.delete()
+        self.assertFalse(FollowCounter.objects.filter(content_type=group_ct,
+            object_id=group_pk).exists())
+
+    def test_suggest_follows(self):
+        self.assertEqual(suggest_follows(self.user1), [])
+        call_command('actstream_build_suggestions', verbosity=0)
+        self.assertEqual(suggest_follows(self.user1), [self.group])
+        follow(self.user1, self.group)
+        self.assertEqual(suggest_follows(self.user1), [])
+
+    def test_suggestions_affected_users(self):
+        since_id = Follow.objects.order_by('-pk')[0].pk
+        user3 = User.objects.create(username='three')
+        follow(user3, self.group)
+        graph = FollowGraph.from_rows(follow_rows(),
+            ContentType.objects.get_for_model(User).pk)
+        # user2 also follows the group, user1 follows user2
+        self.assertEqual(suggestions.affected_users(graph, since_id),
+            sorted([self.user1.pk, self.user2.pk, user3.pk]))
+
+    def test_follow_bloom(self):
+        old_FOLLOW_BLOOM = bloom.FOLLOW_BLOOM
+        bloom.FOLLOW_BLOOM = True
+        try:
+            bloom.invalidate(self.user1.pk)
+            self.assertTrue(Follow.objects.is_following(self.user1,
+                self.user2))
+            self.assertNumQueries(0, lambda: self.assertFalse(
+                Follow.objects.is_following(self.user1, self.group)))
+            version = actstream_cache.get_versions([
+                bloom.version_key(self.user1.pk)])[0]
+            Follow.objects.create(user=self.user1, object_id=self.group.pk,
+                content_type=ContentType.objects.get_for_model(Group))
+            bloom.invalidate(self.user1.pk)
+            # a rebuild that started before the change stores a stale filter
+            cache.set(bloom.cache_key(self.user1.pk, version),
+                bloom.BloomFilter(1))
+            # the filter of the previous check is memoized on the instance
+            user = User.objects.get(pk=self.user1.pk)
+            self.assertTrue(Follow.objects.is_following(user, self.group))
+
+            # the test transaction is managed: the commit bumps again
+            version = actstream_cache.get_versions([
+                bloom.version_key(self.user1.pk)])[0]
+            actstream_cache.flush_follow_versions()
+            self.assertNotEqual(actstream_cache.get_versions([
+                bloom.version_key(self.user1.pk)])[0], version)
+        finally:
+            bloom.FOLLOW_BLOOM = old_FOLLOW_BLOOM
+            actstream_cache.flush_follow_versions()
+
+    def test_bloom_filter(self):
+        bloom_filter = bloom.BloomFilter(100)
+        for i in range(100):
+            bloom_filter.add('12:%d' % i)
+        for i in range(100):
+            self.assertTrue('12:%d' % i in bloom_filter)
+        self.assertTrue(len([i for i in range(100, 1100)
+            if '12:%d' % i in bloom_filter]) < 50)
+
     def test_is_following_filter(self):
         src = '{% load activity_tags %}{% if user|is_following:group %}yup{% endif %}'
         self.assertEqual(Template(src).render(Context({
@@ -320,6 +966,7 @@ class GFKManagerTestCase(TestCase):
             target_content_type=self.group_ct,
             target_object_id=self.group.id
         )
+        registry.warm()
 
     def test_fetch_generic_relations(self):
         # baseline without fetch_generic_relations
@@ -333,7 +980,7 @@ class GFKManagerTestCase(TestCase):
         # compare to fetching only 1 generic relation
         self.assertNumQueries(n + 1,
             lambda: [a.target for a in actions()])
-        self.assertNumQueries(num_content_types + 2,
+        self.assertNumQueries(num_content_types + 1,
             lambda: [a.target for a in
                 actions().fetch_generic_relations('target')])
 
@@ -347,7 +994,7 @@ class GFKManagerTestCase(TestCase):
             'actor_content_type_id', 'target_content_type_id'), ())))
         self.assertNumQueries(2 * n + 1,
             lambda: [(a.actor, a.target) for a in actions()])
-        self.assertNumQueries(num_content_types + 2,
+        self.assertNumQueries(num_content_types + 1,
             lambda: [(a.actor, a.target) for a in
                 actions().fetch_generic_relations()])
 
@@ -359,7 +1006,7 @@ class GFKManagerTestCase(TestCase):
             action_actor_targets_fetch_generic_all)
 
         # fetch only 1 generic relation, but access both gfks
-        self.assertNumQueries(n + num_content_types + 2,
+        self.assertNumQueries(n + num_content_types + 1,
             lambda: [(a.actor, a.target) for a in
                 actions().fetch_generic_relations('target')])
         action_actor_targets_fetch_generic_target = [
@@ -367,3 +1014,42 @@ class GFKManagerTestCase(TestCase):
                 actions().fetch_generic_relations('target')]
         self.assertEqual(action_actor_targets,
             action_actor_targets_fetch_generic_target)
+
+    def test_fetch_generic_relations_stats(self):
+        received = []
+
+        def receiver(sender, stats, **kwargs):
+            received.append((sender, stats))
+        generic_relations_fetched.connect(receiver)
+        registry.clear()
+        fetch = lambda: list(Action.objects.filter(
+            actor_content_type=self.user_ct,
+            actor_object_id=self.user1.id).fetch_generic_relations())
+        try:
+            # The cold ContentType registry costs one more query
+            self.assertNumQueries(4, fetch)
+            self.assertNumQueries(3, fetch)
+        finally:
+            generic_relations_fetched.disconnect(receiver)
+
+        self.assertEqual(len(received), 2)
+        sender, stats = received[0]
+        self.assertEqual(sender, Action)
+        self.assertEqual(stats['rows'], 4)
+        self.assertEqual(stats['content_types'], 2)
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(stats['queries'], 4)
+        self.assertEqual(stats['missing'], 0)
+        self.assertTrue(stats['time'] >= 0)
+        self.assertEqual(received[1][1]['queries'], 3)
+
+
+class ContentTypeRegistryTestCase(TestCase):
+
+    def test_lookups_use_registry(self):
+        user_ct = ContentType.objects.get_for_model(User)
+        registry.warm()
+        self.assertNumQueries(0, lambda: registry.get_content_type(user_ct.pk))
+        self.assertEqual(registry.get_model_class(str(user_ct.pk)), User)
+        self.assertRaises(ContentType.DoesNotExist,
+            registry.get_content_type, 'abc')
@@ -0,0 +1,105 @@
+"""
+Batched URL resolution for rendering lists of actions.
+
+``reverse`` resolves every URL name once per URL configuration, script
+prefix and active language, with sentinel arguments, and builds later URLs by substituting the
+actual arguments into the result. Only numeric arguments are substituted;
+anything else goes through ``django.core.urlresolvers.reverse``.
+
+``object_url`` memoizes the URL of every object per ``(model, pk)`` while a
+function decorated with ``memoize_urls`` runs in the current thread.
+"""
+import re
+from functools import wraps
+from threading import local
+
+from django.conf import settings
+from django.core import urlresolvers
+from django.utils.encoding import smart_unicode
+from django.utils.translation import get_language
+from django.contrib.contenttypes.models import ContentType
+
+SENTINEL = 7350293
+DIGITS = re.compile(r'^\d+$')
+
+_templates = {}
+_local = local()
+
+
+def _url_template(viewname, count):
+    """
+    URL of ``viewname`` with ``%s`` placeholders for its ``count``
+    arguments, False if the URL can not be built that way.
+    """
+    sentinels = [str(SENTINEL + i) for i in range(count)]
+    try:
+        url = urlresolvers.reverse(viewname, None, sentinels)
+    except urlresolvers.NoReverseMatch:
+        return False
+    positions = [url.find(sentinel) for sentinel in sentinels]
+    if -1 in positions or positions != sorted(positions) or \
+            [url.count(sentinel) for sentinel in sentinels] != [1] * count:
+        return False
+    template = url.replace('%', '%%')
+    for sentinel in sentinels:
+        template = template.replace(sentinel, '%s')
+    return template
+
+
+def reverse(viewname, args=()):
+    """
+    Same as ``django.core.urlresolvers.reverse(viewname, args=args)``,
+    reversing each URL name only once.
+    """
+    args = [smart_unicode(arg) for arg in args]
+    for arg in args:
+        if not DIGITS.match(arg):
+            return urlresolvers.reverse(viewname, None, args)
+    key = (urlresolvers.get_urlconf() or settings.ROOT_URLCONF,
+        urlresolvers.get_script_prefix(), get_language(), viewname,
+        len(args))
+    template = _templates.get(key)
+    if template is None:
+        template = _templates[key] = _url_template(viewname, len(args))
+    if not template:
+        return urlresolvers.reverse(viewname, None, args)
+    return template % tuple(args)
+
+
+def object_url(obj):
+    """
+    URL of ``obj``: its ``get_absolute_url`` or the ``actstream_actor`` view
+    for objects without one.
+    """
+    if obj is None:
+        return ''
+    urls = getattr(_local, 'urls', None)
+    key = (obj.__class__, obj.pk)
+    if urls is not None and key in urls:
+        return urls[key]
+    if hasattr(obj, 'get_absolute_url'):
+        url = obj.get_absolute_url()
+    else:
+        url = reverse('actstream_actor',
+            (ContentType.objects.get_for_model(obj).pk, obj.pk))
+    if urls is not None:
+        urls[key] = url
+    return url
+
+
+def memoize_urls(func):
+    """
+    Decorator memoizing ``object_url`` for the duration of ``func``, usually
+    a view or a template node rendering many actions.
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        outermost = getattr(_local, 'urls', None) is None
+        if outermost:
+            _local.urls = {}
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if outermost:
+                _local.urls = None
+    return wrapped
@@ -14,6 +14,10 @@ urlpatterns = patterns('actstream.views',
         name='actstream_object_feed_as'),
     url(r'^feed/(?P<content_type_id>\d+)/$',
         feeds.ModelActivityFeed(), name='actstream_model_feed'),
+    url(r'^feed/objects/$', feeds.MultiObjectActivityFeed(),
+        name='actstream_objects_feed'),
+    url(r'^feed/objects/atom/$', feeds.AtomMultiObjectActivityFeed(),
+        name='actstream_objects_feed_atom'),
     url(r'^feed/$', feeds.UserActivityFeed(), name='actstream_feed'),
     url(r'^feed/atom/$', feeds.AtomUserActivityFeed(),
         name='actstream_feed_atom'),
@@ -27,11 +31,27 @@ urlpatterns = patterns('actstream.views',
     # Follower and Actor lists
     url(r'^followers/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
         'followers', name='actstream_followers'),
+    url(r'^followers/(?P<content_type_id>\d+)/(?P<object_id>\d+)/json/$',
+        'followers_json', name='actstream_followers_json'),
     url(r'^actors/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
         'actor', name='actstream_actor'),
     url(r'^actors/(?P<content_type_id>\d+)/$',
         'model', name='actstream_model'),
 
+    # JSON Activity Streams
+    url(r'^actors/(?P<content_type_id>\d+)/(?P<object_id>\d+)/json/$',
+        'actor_json', name='actstream_actor_json'),
+    url(r'^actors/(?P<content_type_id>\d+)/json/$',
+        'model_json', name='actstream_model_json'),
+    url(r'^json/$', 'stream_json', name='actstream_json'),
+
+    # Live updates
+    url(r'^actors/(?P<content_type_id>\d+)/(?P<object_id>\d+)/live/$',
+        'actor_live', name='actstream_actor_live'),
+    url(r'^actors/(?P<content_type_id>\d+)/live/$',
+        'model_live', name='actstream_model_live'),
+    url(r'^live/$', 'stream_live', name='actstream_live'),
+
     url(r'^detail/(?P<action_id>\d+)/$', 'detail', name='actstream_detail'),
     url(r'^(?P<username>[-\w]+)/$', 'user', name='actstream_user'),
     url(r'^$', 'stream', name='actstream'),
@@ -1,13 +1,21 @@
+from time import time
+
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, \
+    HttpResponseBadRequest, Http404
+from django.utils import simplejson
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.views.decorators.csrf import csrf_exempt
 
-from actstream import actions, models
+from actstream import actions, activitystreams, live, models, \
+    settings as actstream_settings
+from actstream.feeds import StreamingHttpResponse
+from actstream.registry import get_content_type_or_404
+from actstream.urlcache import memoize_urls
 
 
 def respond(request, code):
@@ -27,7 +35,7 @@ def follow_unfollow(request, content_type_id, object_id, do_follow=True):
     Creates or deletes the follow relationship between ``request.user`` and the
     actor defined by ``content_type_id``, ``object_id``.
     """
-    ctype = get_object_or_404(ContentType, pk=content_type_id)
+    ctype = get_content_type_or_404(content_type_id)
     actor = get_object_or_404(ctype.model_class(), pk=object_id)
 
     if do_follow:
@@ -38,6 +46,7 @@ def follow_unfollow(request, content_type_id, object_id, do_follow=True):
 
 
 @login_required
+@memoize_urls
 def stream(request):
     """
     Index page for authenticated user's activity stream. (Eg: Your feed at
@@ -49,20 +58,79 @@ def stream(request):
     }, context_instance=RequestContext(request))
 
 
+def _followers_page(request, content_type_id, object_id):
+    ctype = get_content_type_or_404(content_type_id)
+    actor = get_object_or_404(ctype.model_class(), pk=object_id)
+    try:
+        after = int(request.GET['after'])
+    except (KeyError, ValueError):
+        after = None
+    followers, cursor = models.Follow.objects.followers_page(actor, after,
+        actstream_settings.FOLLOWERS_PAGE_SIZE)
+    return actor, followers, cursor
+
+
 def followers(request, content_type_id, object_id):
     """
     Creates a listing of ``User``s that follow the actor defined by
-    ``content_type_id``, ``object_id``.
+    ``content_type_id``, ``object_id``, one page at a time. The ``after``
+    parameter is the cursor of the page to show.
     """
-    ctype = get_object_or_404(ContentType, pk=content_type_id)
-    follows = models.Follow.objects.filter(content_type=ctype,
-        object_id=object_id)
-    actor = get_object_or_404(ctype.model_class(), pk=object_id)
+    actor, followers, cursor = _followers_page(request, content_type_id,
+        object_id)
     return render_to_response('activity/followers.html', {
-        'followers': (f.user for f in follows), 'actor': actor
+        'followers': followers, 'actor': actor, 'next_cursor': cursor
     }, context_instance=RequestContext(request))
 
 
+def followers_json(request, content_type_id, object_id):
+    """
+    JSON variant of ``followers``.
+    """
+    actor, followers, cursor = _followers_page(request, content_type_id,
+        object_id)
+    return HttpResponse(simplejson.dumps({
+        'followers': [{'id': user.pk, 'username': user.username,
+            'name': user.get_full_name()} for user in followers],
+        'next': cursor,
+    }), mimetype='application/json')
+
+
+def _json_stream(request, stream, obj):
+    """
+    Responds with a page of ``stream(obj)`` in JSON Activity Streams format.
+
+    The ``fields`` parameter selects a comma separated subset of
+    ``activitystreams.FIELDS``, ``limit`` the number of actions (at most
+    ``ACTSTREAM_JSON_PAGE_SIZE``) and ``before`` is the cursor of the page to
+    show, returned as ``next`` by the previous page.
+    """
+    try:
+        fields = activitystreams.parse_fields(request.GET.get('fields'))
+        limit = min(int(request.GET.get('limit',
+            actstream_settings.JSON_PAGE_SIZE)),
+            actstream_settings.JSON_PAGE_SIZE)
+        cursor = None
+        if request.GET.get('before'):
+            cursor = activitystreams.decode_cursor(request.GET['before'])
+    except ValueError:
+        return HttpResponseBadRequest()
+    collection, cursor = activitystreams.serialize(stream(obj, _fetch=False,
+        _before=cursor), fields, max(limit, 1), request.build_absolute_uri)
+    collection['next'] = cursor
+    return HttpResponse(simplejson.dumps(collection),
+        mimetype='application/json')
+
+
+@login_required
+def stream_json(request):
+    """
+    JSON variant of ``stream``.
+    """
+    return _json_stream(request, models.user_stream, request.user)
+
+
+@memoize_urls
 def user(request, username):
     """
     ``User`` focused activity stream. (Eg: Profile page twitter.com/justquick)
@@ -83,12 +151,13 @@ def detail(request, action_id):
     }, context_instance=RequestContext(request))
 
 
+@memoize_urls
 def actor(request, content_type_id, object_id):
     """
     ``Actor`` focused activity stream for actor defined by ``content_type_id``,
     ``object_id``.
     """
-    ctype = get_object_or_404(ContentType, pk=content_type_id)
+    ctype = get_content_type_or_404(content_type_id)
     actor = get_object_or_404(ctype.model_class(), pk=object_id)
     return render_to_response('activity/actor.html', {
         'action_list': models.actor_stream(actor), 'actor': actor,
@@ -96,14 +165,99 @@ def actor(request, content_type_id, object_id):
     }, context_instance=RequestContext(request))
 
 
+def actor_json(request, content_type_id, object_id):
+    """
+    JSON variant of ``actor``.
+    """
+    ctype = get_content_type_or_404(content_type_id)
+    actor = get_object_or_404(ctype.model_class(), pk=object_id)
+    return _json_stream(request, models.actor_stream, actor)
+
+
+@memoize_urls
 def model(request, content_type_id):
     """
     ``Actor`` focused activity stream for actor defined by ``content_type_id``,
     ``object_id``.
     """
-    ctype = get_object_or_404(ContentType, pk=content_type_id)
+    ctype = get_content_type_or_404(content_type_id)
     actor = ctype.model_class()
     return render_to_response('activity/actor.html', {
         'action_list': models.model_stream(actor), 'ctype': ctype,
         'actor': ctype
     }, context_instance=RequestContext(request))
+
+
+def model_json(request, content_type_id):
+    """
+    JSON variant of ``model``.
+    """
+    return _json_stream(request, models.model_stream,
+        get_content_type_or_404(content_type_id).model_class())
+
+
+def _sse_events(matches, after):
+    """
+    Server-Sent Events of the actions published after ``after``, with a
+    comment every ``ACTSTREAM_LIVE_HEARTBEAT`` seconds to keep the
+    connection open, until ``ACTSTREAM_LIVE_TIMEOUT`` seconds have passed.
+    """
+    yield 'retry: 3000\n\n'
+    deadline = time() + live.LIVE_TIMEOUT
+    while time() < deadline:
+        events, after = live.hub.read(after, matches,
+            min(live.LIVE_HEARTBEAT, max(deadline - time(), 0)))
+        if not events:
+            yield ': heartbeat\n\n'
+        for event, item in events:
+            yield 'id: %s\nevent: action\ndata: %s\n\n' % (
+                live.hub.cursor(event.sequence), simplejson.dumps(item))
+
+
+def _live_stream(request, matches):
+    """
+    Pushes the new actions matched by ``matches`` as Server-Sent Events or,
+    with the ``poll`` parameter, responds to a long-poll with the JSON list
+    of actions published after the ``after`` cursor and the cursor to poll
+    after next.
+    """
+    if not live.LIVE:
+        raise Http404
+    after = live.hub.parse_cursor(request.META.get('HTTP_LAST_EVENT_ID',
+        request.GET.get('after')))
+    if 'poll' in request.GET:
+        events, after = live.hub.read(after, matches, live.LIVE_POLL_TIMEOUT)
+        return HttpResponse(simplejson.dumps({
+            'items': [item for event, item in events],
+            'next': live.hub.cursor(after),
+        }), mimetype='application/json')
+    response = StreamingHttpResponse(_sse_events(matches, after),
+        mimetype='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@login_required
+def stream_live(request):
+    """
+    Live variant of ``stream``.
+    """
+    return _live_stream(request, live.user_matcher(request.user))
+
+
+def actor_live(request, content_type_id, object_id):
+    """
+    Live variant of ``actor``.
+    """
+    ctype = get_content_type_or_404(content_type_id)
+    actor = get_object_or_404(ctype.model_class(), pk=object_id)
+    return _live_stream(request, live.object_matcher('actor', ctype.pk,
+        actor.pk))
+
+
+def model_live(request, content_type_id):
+    """
+    Live variant of ``model``.
+    """
+    return _live_stream(request, live.model_matcher(
+        get_content_type_or_404(content_type_id).pk))
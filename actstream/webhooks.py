@@ -0,0 +1,226 @@
+"""
+Delivery of new actions to webhook subscriptions.
+
+Creating an action only inserts one ``WebhookDelivery`` outbox row per
+matching subscription. The ``actstream_send_webhooks`` command sends the due
+rows in batches, one POST of a JSON Activity Streams collection per
+subscription, over connections kept open between batches. Failed batches
+are retried with exponential backoff until ``ACTSTREAM_WEBHOOK_MAX_ATTEMPTS``
+attempts have been made.
+
+Each batch is claimed in a short transaction, which moves the next attempt
+of its rows ``ACTSTREAM_WEBHOOK_CLAIM_TIMEOUT`` seconds ahead, and sent
+outside of it: concurrent runners skip claimed rows, and the rows of a
+runner that died become due again once the claim expires.
+"""
+import hmac
+import httplib
+import socket
+from datetime import datetime, timedelta
+from hashlib import sha1
+from urlparse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import simplejson
+
+WEBHOOKS = getattr(settings, 'ACTSTREAM_WEBHOOKS', False)
+WEBHOOK_BATCH_SIZE = getattr(settings, 'ACTSTREAM_WEBHOOK_BATCH_SIZE', 100)
+WEBHOOK_MAX_ATTEMPTS = getattr(settings, 'ACTSTREAM_WEBHOOK_MAX_ATTEMPTS', 10)
+WEBHOOK_BACKOFF = getattr(settings, 'ACTSTREAM_WEBHOOK_BACKOFF', 30)
+WEBHOOK_MAX_BACKOFF = getattr(settings, 'ACTSTREAM_WEBHOOK_MAX_BACKOFF',
+    60 * 60 * 6)
+WEBHOOK_TIMEOUT = getattr(settings, 'ACTSTREAM_WEBHOOK_TIMEOUT', 10)
+WEBHOOK_CLAIM_TIMEOUT = getattr(settings, 'ACTSTREAM_WEBHOOK_CLAIM_TIMEOUT',
+    60 * 10)
+
+SIGNATURE_HEADER = 'X-Actstream-Signature'
+
+
+def enqueue_handler(sender, instance=None, actions=(), created=True,
+        **kwargs):
+    """
+    Adds the new public actions, saved one by one or bulk created, to the
+    outbox of every active subscription accepting their verb.
+    """
+    from actstream.actions import _bulk_create
+    from actstream.models import WebhookSubscription, WebhookDelivery
+
+    if not created:
+        return
+    actions = [action for action in
+        (instance is not None and [instance] or actions)
+        if action.public and action.pk is not None]
+    if not actions:
+        return
+    deliveries = []
+    for subscription in WebhookSubscription.objects.filter(active=True):
+        verbs = subscription.get_verbs()
+        deliveries.extend([WebhookDelivery(subscription=subscription,
+            action=action) for action in actions
+            if not verbs or action.verb in verbs])
+    if deliveries:
+        _bulk_create(WebhookDelivery, deliveries)
+
+
+def backoff(attempts):
+    """
+    Delay before the next attempt after ``attempts`` failed ones.
+    """
+    return timedelta(seconds=min(WEBHOOK_BACKOFF * 2 ** (attempts - 1),
+        WEBHOOK_MAX_BACKOFF))
+
+
+def sign(secret, body):
+    """
+    Value of the ``X-Actstream-Signature`` header: the hex HMAC-SHA1 of the
+    request body keyed with the subscription secret.
+    """
+    return hmac.new(str(secret), body, sha1).hexdigest()
+
+
+class ConnectionPool(object):
+    """
+    Keeps one open HTTP connection per scheme, host and port.
+    """
+
+    def __init__(self, timeout=WEBHOOK_TIMEOUT):
+        self.timeout = timeout
+        self.connections = {}
+
+    def post(self, url, body, headers):
+        """
+        POSTs ``body`` to ``url`` and returns the response status. Raises
+        ``socket.error`` or ``httplib.HTTPException`` on failure, after
+        dropping the connection. A kept open connection the server closed
+        in the meantime is replaced and the request sent once more.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        while True:
+            connection = self.connections.get(key)
+            reused = connection is not None
+            if connection is None:
+                if parts.scheme == 'https':
+                    connection_class = httplib.HTTPSConnection
+                else:
+                    connection_class = httplib.HTTPConnection
+                connection = self.connections[key] = connection_class(
+                    parts.netloc, timeout=self.timeout)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (socket.error, httplib.HTTPException):
+                self.discard(key)
+                if reused:
+                    continue
+                raise
+            if response.getheader('connection', '').lower() == 'close':
+                self.discard(key)
+            return response.status
+
+    def discard(self, key):
+        connection = self.connections.pop(key, None)
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        for key in self.connections.keys():
+            self.discard(key)
+
+
+def _absolute_uri(url):
+    from django.contrib.sites.models import Site
+    from actstream.settings import URL_SCHEME
+
+    return '%s://%s%s' % (URL_SCHEME, Site.objects.get_current().domain, url)
+
+
+def send_batch(pool, subscription, action_ids):
+    """
+    POSTs the actions to the subscription. Returns None on success, the
+    error otherwise.
+    """
+    from actstream import activitystreams
+    from actstream.models import Action
+
+    collection = activitystreams.serialize(Action.objects.filter(
+        pk__in=action_ids), limit=len(action_ids),
+        absolute_uri=_absolute_uri)[0]
+    body = simplejson.dumps(collection)
+    headers = {'Content-Type': 'application/json'}
+    if subscription.secret:
+        headers[SIGNATURE_HEADER] = sign(subscription.secret, body)
+    try:
+        status = pool.post(subscription.url, body, headers)
+    except (socket.error, httplib.HTTPException) as e:
+        return u'%s: %s' % (e.__class__.__name__, e)
+    if not 200 <= status < 300:
+        return u'HTTP %d' % status
+
+
+@transaction.commit_on_success
+def claim(batch_size=WEBHOOK_BATCH_SIZE):
+    """
+    Locks up to ``batch_size`` due deliveries, moves their next attempt past
+    the claim timeout and returns their ``(id, subscription, action,
+    attempts)`` rows. The transaction ends before anything is sent.
+    """
+    from actstream.models import WebhookDelivery
+
+    now = datetime.now()
+    due = list(WebhookDelivery.objects.select_for_update().filter(
+        next_attempt__lte=now).order_by('next_attempt', 'id')
+        .values_list('id', 'subscription', 'action', 'attempts')[:batch_size])
+    if due:
+        WebhookDelivery.objects.filter(pk__in=[row[0] for row in due])\
+            .update(next_attempt=now + timedelta(
+                seconds=WEBHOOK_CLAIM_TIMEOUT))
+    return due
+
+
+def deliver(pool, batch_size=WEBHOOK_BATCH_SIZE):
+    """
+    Claims and sends up to ``batch_size`` due deliveries, grouped by
+    subscription. Delivered rows and rows of inactive subscriptions are
+    deleted, failed ones rescheduled. Returns the numbers of delivered,
+    failed and dropped rows.
+    """
+    from actstream.models import WebhookSubscription, WebhookDelivery
+
+    due = claim(batch_size)
+    batches = {}
+    for row in due:
+        batches.setdefault(row[1], []).append(row)
+    subscriptions = WebhookSubscription.objects.in_bulk(batches.keys())
+
+    delivered = failed = dropped = 0
+    for subscription_id, rows in batches.items():
+        subscription = subscriptions.get(subscription_id)
+        ids = [row[0] for row in rows]
+        if subscription is None or not subscription.active:
+            WebhookDelivery.objects.filter(pk__in=ids).delete()
+            dropped += len(rows)
+            continue
+        error = send_batch(pool, subscription, [row[2] for row in rows])
+        if error is None:
+            WebhookDelivery.objects.filter(pk__in=ids).delete()
+            delivered += len(rows)
+            continue
+        failed += len(rows)
+        now = datetime.now()
+        by_attempts = {}
+        for row in rows:
+            by_attempts.setdefault(row[3] + 1, []).append(row[0])
+        for attempts, attempt_ids in by_attempts.items():
+            next_attempt = None
+            if attempts < WEBHOOK_MAX_ATTEMPTS:
+                next_attempt = now + backoff(attempts)
+            WebhookDelivery.objects.filter(pk__in=attempt_ids).update(
+                attempts=attempts, next_attempt=next_attempt,
+                last_error=error)
+    return delivered, failed, dropped
@@ -10,7 +10,8 @@ setup(name='django-activity-stream',
       author='Justin Quick',
       author_email='justquick@gmail.com',
       url='http://github.com/justquick/django-activity-stream',
-      packages=['actstream', 'actstream.templatetags'],
+      packages=['actstream', 'actstream.templatetags',
+                'actstream.management', 'actstream.management.commands'],
       package_data={'actstream': ['templates/activity/*.html']},
       classifiers=['Development Status :: 5 - Production/Stable',
                    'Environment :: Web Environment',